@@ -0,0 +1,321 @@
+# asyncio transport for the TCP-like GBN protocol
+# Same packet format and FSMs as gbn.py, so both interoperate,
+# but many sessions can run in one thread on an event loop.
+
+import asyncio, logging
+
+from gbn import Ev, State, Timer, SendFSM, RecvFSM, TO_interval, MSS, sender_port, receiver_port, \
+    Message, StreamBuffer
+from packet import seqclass
+
+
+async def open(peer_host, N, passive=False, linger=2, seqbits=8, sack=False, cc=None,
+               delayed_ack=True, mss=MSS, link=None, fec=0, compress=0, sid=None,
+               local_port=None, peer_port=None, queue_bytes=None):
+    """Open GBN protocol entity on the running event loop
+
+    :param peer_host: peer host name
+    :param passive: for sending (default), for receiving if True
+    :param linger: seconds to keep the sender's endpoint after closing
+    :param seqbits: sequence number width: 8, 16 or 32
+    :param sack: for sending, ask for selective ACKs
+    :param cc: for sending, congestion control policy; fixed window N if None
+    :param delayed_ack: for receiving, ACK every second packet or on TO_DelayedACK
+    :param mss: for sending, max payload bytes in a DATA packet
+    :param link: netem.Link emulating the outgoing direction
+    :param fec: for sending, a parity packet every fec DATA packets; 0 for none
+    :param compress: for sending, zlib level compressing the data; 0 for none
+    :param sid: for sending, session id to a GBNListener
+    :param local_port: local port, 0 for an ephemeral one; if None, sender_port or
+                       receiver_port, or an ephemeral one for a sender with sid
+    :param peer_port: peer port, receiver_port or sender_port if None
+    :param queue_bytes: for receiving, bytes the receive buffer holds before the window
+                        closes, N * MSS by default
+    :return: AsyncGBNsend or AsyncGBNrecv object
+    """
+    assert N <= seqclass(seqbits).HALF, "N: too big"
+    loop = asyncio.get_running_loop()
+    if passive:
+        if local_port is None:
+            local_port = receiver_port
+        _, gbn = await loop.create_datagram_endpoint(
+            lambda: AsyncGBNrecv(N, loop, seqbits, delayed_ack, link, queue_bytes),
+            local_addr=('0.0.0.0', local_port),
+            remote_addr=(peer_host, sender_port if peer_port is None else peer_port))
+        logging.info('app receiver starts')
+    else:
+        if local_port is None:
+            local_port = sender_port if sid is None else 0
+        _, gbn = await loop.create_datagram_endpoint(
+            lambda: AsyncGBNsend(N, loop, linger, seqbits, sack, cc, mss, link, fec, compress,
+                                 sid),
+            local_addr=('0.0.0.0', local_port),
+            remote_addr=(peer_host, receiver_port if peer_port is None else peer_port))
+        logging.info('app sender starts')
+    return gbn
+
+
+class AsyncTimer(Timer):
+    """Timer firing timeout events into the FSM with loop.call_at
+    """
+    def __init__(self, loop, handle, intv:dict=TO_interval):
+        """
+        :param loop: event loop
+        :param handle: callback taking the timeout event
+        """
+        Timer.__init__(self, intv, loop.time)
+        self.loop = loop
+        self.handle = handle
+        self.handles = {}
+
+    def start_timer(self, key:Ev):
+        self.stop_timer(key)
+        when = self.loop.time() + self.intv[key]
+        self.handles[key] = self.loop.call_at(when, self._expire, key)
+
+    def stop_timer(self, key:Ev):
+        handle = self.handles.pop(key, None)
+        if handle:
+            handle.cancel()
+
+    def running(self, key:Ev):
+        return key in self.handles
+
+    def _expire(self, key:Ev):
+        del self.handles[key]
+        self.handle(key)
+
+
+# GBN abstract super class driven by an asyncio event loop
+class AsyncGBN(asyncio.DatagramProtocol):
+    def __init__(self, loop):
+        self.loop = loop
+        self.transport = None
+        self.closed = loop.create_future()  # done when the FSM reaches Closed
+
+    # asyncio.DatagramProtocol interface
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, pdu, addr):
+        self.handle(Ev.Packet_Arrival, self.make_rcvpkt(pdu))
+
+    def error_received(self, exc):
+        logging.info(f'{self.__class__.__name__}: {exc!r}')
+
+    def connection_lost(self, exc):
+        if not self.closed.done():
+            self.closed.set_exception(exc or ConnectionError('endpoint closed'))
+
+    # lower layer(UDT) interface
+    def transmit(self, buffers, delay=0.):
+        """Send via connected datagram transport, delayed without blocking the loop"""
+        pdu = b''.join(buffers)     # datagram transports have no scatter/gather
+        if delay > 0:
+            self.loop.call_later(delay, self._sendto, pdu)
+        else:
+            self._sendto(pdu)
+
+    def _sendto(self, pdu):
+        if not self.transport.is_closing():
+            self.transport.sendto(pdu)
+
+    def handle(self, event, chunk=''):
+        """Run the FSM for an event, then notify waiters"""
+        self.transition(event, chunk)
+        if self.state == State.Closed and not self.closed.done():
+            self.closed.set_result(None)
+            self.on_closed()
+
+    def on_closed(self):
+        self.transport.close()
+
+
+# GBN Sending-side Protocol Entity on asyncio
+class AsyncGBNsend(AsyncGBN, SendFSM):
+    def __init__(self, N, loop, linger=2, seqbits=8, sack=False, cc=None, mss=MSS, link=None,
+                 fec=0, compress=0, sid=None):
+        """GBN sending-side
+
+        :param N:    send window size
+        :param loop: event loop
+        :param linger: seconds to keep the endpoint after closing
+        :param seqbits: sequence number width
+        :param sack: ask for selective ACKs
+        :param cc: congestion control policy name or object, fixed window if None
+        :param mss: max payload bytes in a DATA packet
+        :param link: netem.Link emulating the path to the receiver
+        :param fec: DATA packets per parity packet, 0 for no FEC
+        :param compress: zlib level compressing the data, 0 for none
+        :param sid: session id to a GBNListener, if any
+        """
+        AsyncGBN.__init__(self, loop)
+        SendFSM.__init__(self, N, AsyncTimer(loop, self.handle), sid=sid, seqbits=seqbits,
+                         sack=sack, cc=cc, mss=mss, link=link, fec=fec, compress=compress)
+        self.linger = linger
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def handle(self, event, chunk=''):
+        AsyncGBN.handle(self, event, chunk)
+        if self.buffer_open():
+            self.writable.set()
+        else:
+            self.writable.clear()
+
+    def on_closed(self):
+        # to avoid ConnectionResetError in Windows on the peer
+        self.loop.call_later(self.linger, self.transport.close)
+
+    # API - called by sending applications
+    async def send(self, data):
+        """Send data, waiting while the send buffer is full
+        """
+        if not isinstance(data, (bytes, bytearray)):
+            raise TypeError('Data should be bytes or bytearray type')
+        if data:
+            await self._request(data)
+
+    async def sendall(self, data):
+        """Send bytes-like data, in pieces of up to the send buffer size
+        """
+        view = memoryview(data).cast('B')
+        step = self.sndq_limit
+        for i in range(0, len(view), step):
+            await self._request(view[i:i+step])
+
+    async def send_message(self, data):
+        """Send data as one message, going out without waiting for a full packet
+        """
+        if not isinstance(data, (bytes, bytearray)):
+            raise TypeError('Data should be bytes or bytearray type')
+        if not data:
+            raise ValueError('empty message')
+        await self._request(Message(data))
+
+    async def send_many(self, chunks):
+        """Send the chunks, waiting only while the send buffer is full
+        """
+        for data in chunks:
+            await self.send(data)
+
+    async def flush(self):
+        """Send the data buffered without waiting for a full packet
+        """
+        await self._request(None)
+
+    async def close(self):
+        """Close the session, waiting until all data are ACKnowledged
+
+        :raise ConnectionError: if the peer stopped answering, the data left unsent
+        """
+        await self._request(b'')    # empty byte denotes end of data
+        await self.closed
+        if self.failed:
+            raise ConnectionError('the peer stopped answering')
+        logging.info('app terminates')
+
+    async def _request(self, data):
+        while self.state == State.Wait and not self.fin_pending and not self.buffer_open():
+            await self.writable.wait()
+        if self.state != State.Wait or self.fin_pending:
+            raise ConnectionError('session closing')
+        self.handle(Ev.App_Request, data)
+
+
+# GBN Receiving-side Protocol Entity on asyncio
+class AsyncGBNrecv(AsyncGBN, RecvFSM):
+    def __init__(self, N, loop, seqbits=8, delayed_ack=True, link=None, queue_bytes=None):
+        """GBN receiving-side
+
+        :param N:    receive window size
+        :param loop: event loop
+        :param seqbits: sequence number width
+        :param delayed_ack: ACK every second packet or on TO_DelayedACK
+        :param link: netem.Link emulating the path to the sender
+        :param queue_bytes: bytes the receive buffer holds before the window closes,
+                            N * MSS by default
+        """
+        AsyncGBN.__init__(self, loop)
+        RecvFSM.__init__(self, N, AsyncTimer(loop, self.handle), seqbits=seqbits,
+                         delayed_ack=delayed_ack, link=link)
+        # in-order data are written straight into the stream buffer
+        self.stream = self.sink = StreamBuffer(queue_bytes or N * MSS, self.window_update)
+        self.readable = asyncio.Event()
+
+    def handle(self, event, chunk=''):
+        AsyncGBN.handle(self, event, chunk)
+        self.readable.set()
+
+    def on_closed(self):
+        self.stream.finish()
+        AsyncGBN.on_closed(self)
+
+    def connection_lost(self, exc):
+        AsyncGBN.connection_lost(self, exc)
+        self.stream.finish()
+        self.readable.set()
+
+    def deliver(self, data):
+        self.stream.write(data)
+        logging.debug('deliver: %s', data)
+
+    def window_update(self):
+        """Advertise the window opened by the app"""
+        if self.state != State.Closed:
+            self.handle(Ev.App_Request, None)
+
+    async def _wait(self, ready):
+        while not ready():
+            self.readable.clear()
+            await self.readable.wait()
+
+    # API - called by receiving applications
+    async def recv(self, max_bytes=None):
+        """Receive the in-order bytes ready, as a stream
+
+        :param max_bytes: max bytes to return, all the data ready if None
+        :return: data (bytes type), b'' at the end of data
+        """
+        await self._wait(self.stream.ready)
+        return self.stream.read(max_bytes, 0)
+
+    async def recv_into(self, buffer):
+        """Receive data into a writable bytes-like buffer
+
+        :return: number of bytes received, 0 at the end of data
+        """
+        await self._wait(self.stream.ready)
+        return self.stream.readinto(buffer, 0)
+
+    async def recv_many(self, max_bytes=None):
+        """Receive the data ready, as a list of chunks
+
+        :param max_bytes: max bytes to return, all the data ready if None
+        :return: list of data chunks, ending with b'' at the end of data
+        """
+        chunks = [await self.recv(max_bytes)]
+        if chunks[0] and self.stream.eof:
+            chunks.append(self.stream.read(0, 0))   # b'', consumed
+        return chunks
+
+    async def recv_message(self):
+        """Receive the next message whole
+
+        :return: data (bytes type), the rest of the data if they end without the end of
+                 a message, b'' at the end of data
+        """
+        try:
+            await self._wait(self.stream.message_ready)
+            return self.stream.read_message(0)
+        finally:
+            self.stream.want = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self.recv()
+        if not data:
+            raise StopAsyncIteration
+        return data
@@ -0,0 +1,438 @@
+# Benchmarks for the GBN protocol implementation
+#   python bench.py [checksum packet seq buffer ack sweep ...] [--json FILE] [--csv FILE]
+#   python bench.py sweep --backend udp --N 16,64 --loss 0,0.01 --delay 0,0.01
+#   (backends: sim in memory, udp GBNsend to GBNrecv, listener GBNsend to a GBNListener session)
+#   python bench.py message --messages 5000
+# Results are printed, and written as JSON/CSV rows to compare versions.
+
+import sys, os, time, json, csv, math, argparse, threading, itertools
+
+from packet import Seq, seqclass, Type, Opt, Packet, PacketBuffer, ichecksum
+from netem import Link
+import gbn, sim
+from conftest import free_port, NullSend
+
+
+def ichecksum_loop(pdu, sum=0):
+    """Reference Internet Checksum adding one byte pair at a time (the former implementation)"""
+    for i in range(0, len(pdu), 2):
+        if i + 1 >= len(pdu):
+            sum += pdu[i]
+        else:
+            sum += (pdu[i] << 8) + pdu[i+1]
+    while (sum >> 16) > 0:
+        sum = (sum & 0xFFFF) + (sum >> 16)
+    sum = ~sum
+    return sum & 0xFFFF
+
+
+def rate(func, min_time=0.5):
+    """Calls per second of func(), measured for at least min_time seconds"""
+    n = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(n):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return n / elapsed
+        n *= 2
+
+
+def bench_checksum(args):
+    """Packets/sec checksummed: byte-pair loop vs. vectorized ichecksum"""
+    rows = []
+    print(f'{"payload":>8} {"loop pkt/s":>12} {"fast pkt/s":>12} {"speedup":>8}')
+    for size in (32, 512, 1400):
+        pdu = Packet(Type.DATA, 0, bytes(range(256)) * (size // 256) + bytes(size % 256)).pdu
+        assert ichecksum_loop(pdu) == ichecksum(pdu) == 0
+        before = rate(lambda: ichecksum_loop(pdu))
+        after = rate(lambda: ichecksum(pdu))
+        print(f'{size:>8} {before:>12,.0f} {after:>12,.0f} {after / before:>7.1f}x')
+        rows.append({'op': 'ichecksum_loop', 'size': size, 'ops_per_sec': before})
+        rows.append({'op': 'ichecksum', 'size': size, 'ops_per_sec': after})
+    return rows
+
+
+def _micro(cases):
+    """Run named microbenchmarks, printing ops/sec"""
+    rows = []
+    for op, func in cases:
+        ops = rate(func)
+        print(f'{op:>28} {ops:>14,.0f} ops/s')
+        rows.append({'op': op, 'ops_per_sec': ops})
+    return rows
+
+
+def bench_packet(args):
+    """Packet making, parsing and checking"""
+    data = bytes(1400)
+    pdu = bytes(Packet(Type.DATA, 7, data).pdu)
+    pdu16 = bytes(Packet(Type.DATA, seqclass(16)(7), data).pdu)
+    return _micro([
+        ('Packet(type, seq, data)', lambda: Packet(Type.DATA, 7, data)),
+        ('Packet(pdu)', lambda: Packet(pdu)),
+        ('Packet(pdu).corrupt()', lambda: Packet(pdu).corrupt()),
+        ('Packet(pdu).seq, 16 bits', lambda: Packet(pdu16).seq),
+        ('Packet.buffers', lambda: Packet(pdu).buffers),
+    ])
+
+
+class SeqObject:
+    """Reference sequence number wrapping an int (the former implementation)"""
+    MOD = 1 << 8
+    HALF = MOD >> 1
+
+    def __init__(self, number):
+        if not isinstance(number, int):
+            raise TypeError('not int type')
+        self.seq = number % self.MOD
+
+    def __add__(self, n):
+        if not isinstance(n, int):
+            raise TypeError('not int type')
+        return self.__class__(self.seq + n)
+
+    def __sub__(self, n):
+        if isinstance(n, SeqObject):
+            n = n.seq
+        if not isinstance(n, int):
+            raise TypeError('not int type')
+        return self.__class__(self.seq - n)
+
+    def __lt__(self, other):
+        if not isinstance(other, SeqObject):
+            raise TypeError('not Seq type')
+        return (self.seq < other.seq and other.seq - self.seq < self.HALF) or \
+               (self.seq > other.seq and self.seq - other.seq > self.HALF)
+
+
+class SeqObject32(SeqObject):
+    MOD = 1 << 32
+    HALF = MOD >> 1
+
+
+def bench_seq(args):
+    """Seq arithmetic and wrap-around comparisons: former object vs. int subclass"""
+    rows = []
+    print(f'{"op":>16} {"former op/s":>14} {"Seq op/s":>14} {"speedup":>8}')
+    Seq32 = seqclass(32)
+    for bits, old, new in ((8, SeqObject, Seq), (32, SeqObject32, Seq32)):
+        cases = []
+        for cls in (old, new):
+            a, b = cls(cls.MOD - 6), cls(3)
+            cases.append({'+ 1': lambda a=a: a + 1, '- Seq': lambda a=a, b=b: b - a,
+                          '< Seq': lambda a=a, b=b: a < b})
+        for op in cases[0]:
+            before, after = rate(cases[0][op]), rate(cases[1][op])
+            print(f'{f"Seq{bits} {op}":>16} {before:>14,.0f} {after:>14,.0f} '
+                  f'{after / before:>7.1f}x')
+            rows.append({'op': f'SeqObject{bits} {op}', 'ops_per_sec': before})
+            rows.append({'op': f'Seq{bits} {op}', 'ops_per_sec': after})
+    return rows
+
+
+def bench_buffer(args):
+    """PacketBuffer as the send and receive window"""
+    N = 64
+    packet = Packet(Type.DATA, 0, bytes(1400))
+
+    def window():   # fill the window, then slide it
+        buf = PacketBuffer(N, Seq(0))
+        for seq in range(N):
+            buf[Seq(seq)] = packet
+        buf.advance_base(Seq(N))
+
+    def deliver():  # receive the window in order, delivering each
+        buf = PacketBuffer(N, Seq(0))
+        for seq in range(N):
+            buf[Seq(seq)] = packet
+            while buf.bitmap & 1:
+                buf.popleft()
+    return _micro([
+        (f'fill+advance window of {N}', window),
+        (f'receive+popleft window of {N}', deliver),
+    ])
+
+
+def bench_ack(args):
+    """ACKs/sec handled by the sending-side FSM: Packet path vs. fast path,
+    with ACKs shaped like GBNrecv's: 16-bit seq, advertising the receive window
+    """
+    N = 64
+    wnd = {Opt.WND: (N * gbn.MSS).to_bytes(4, 'big')}
+    sender = NullSend(N, gbn.Timer(), seqbits=16, link=Link())
+    for _ in range(N // 2):     # half the window in flight, never ACKnowledged
+        sender.send_packet(Type.DATA, bytes(1400))
+    dup = bytes(Packet(Type.ACK, sender.base, options=wnd).pdu)
+    stale = bytes(Packet(Type.ACK, sender.base - 1, options=wnd).pdu)
+    arrival = gbn.Ev.Packet_Arrival
+    sender.transition(arrival, Packet(dup))     # the window learned: duplicates change nothing
+    assert not sender.coalesce_ACKs([dup])
+
+    def window(coalesce):   # a window of packets sent, then their ACKs in a batch
+        s = NullSend(N, gbn.Timer(), seqbits=16, link=Link())
+        for _ in range(N):
+            s.send_packet(Type.DATA, b'')
+        acks = [memoryview(Packet(Type.ACK, s.base + i, options=wnd).pdu)
+                for i in range(1, N + 1)]
+        if coalesce:
+            acks = s.coalesce_ACKs(acks)
+        for pdu in acks:
+            s.transition(arrival, s.received(Packet(pdu)))
+
+    rows = _micro([
+        ('duplicate ACK, Packet path', lambda: sender.transition(arrival, Packet(dup))),
+        ('duplicate ACK, fast path', lambda: sender.coalesce_ACKs([dup])),
+        ('stale ACK, Packet path', lambda: sender.transition(arrival, Packet(stale))),
+        ('stale ACK, fast path', lambda: sender.coalesce_ACKs([stale])),
+    ])
+    for op, coalesce in (('one by one', False), ('coalesced', True)):
+        ops = rate(lambda: window(coalesce)) * N
+        print(f'{f"{N} new ACKs, {op}":>28} {ops:>14,.0f} ACKs/s')
+        rows.append({'op': f'{N} new ACKs, {op}', 'ops_per_sec': ops})
+    return rows
+
+
+def percentile(values, p):
+    """p-th percentile(0-100) of the values, by the nearest rank"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+
+def latencies(written, delivered):
+    """Delivery latency of each app write
+
+    :param written: (time, bytes so far) of each write, in time order
+    :param delivered: (time, bytes so far) of each delivery, in time order
+    """
+    result, i = [], 0
+    for t, total in written:
+        while i < len(delivered) and delivered[i][1] < total:
+            i += 1
+        if i == len(delivered):
+            break
+        result.append(delivered[i][0] - t)
+    return result
+
+
+def run_sim(N, link, reverse, data, write, mss, cc, sack, fec):
+    """Transfer over the in-memory link on the virtual clock"""
+    s = sim.Simulator(N, link, reverse, seqbits=16, sack=sack, cc=cc, mss=mss, fec=fec)
+    if s.run(data, write) != data:
+        raise RuntimeError('data mismatch')
+    done = s.delivered[-1][0]
+    return s.sender.stats, done, latencies(s.written[1:], s.delivered)
+
+
+def run_udp(N, link, reverse, data, write, mss, cc, sack, fec):
+    """Transfer between threads over localhost UDP, from GBNsend to GBNrecv"""
+    sport, rport = free_port(), free_port()
+    gr = gbn.GBNrecv(('127.0.0.1', sport), N, 16, link=reverse, port=rport, linger=0.1)
+    gr.start()
+    sender = gbn.GBNsend(('127.0.0.1', rport), N, seqbits=16, sack=sack, cc=cc, mss=mss,
+                         link=link, port=sport, fec=fec, linger=0.1)
+    return _transfer(sender, lambda: gr, data, write)
+
+
+def run_listener(N, link, reverse, data, write, mss, cc, sack, fec):
+    """Transfer between threads over localhost UDP, from GBNsend to a GBNListener session"""
+    listener = gbn.GBNListener(('127.0.0.1', 0), N, 16, link=reverse)
+    listener.start()
+    sender = gbn.GBNsend(('127.0.0.1', listener.sock.getsockname()[1]), N, sid=1, seqbits=16,
+                         sack=sack, cc=cc, mss=mss, link=link, fec=fec)
+    try:
+        return _transfer(sender, listener.accept, data, write)
+    finally:
+        listener.close()
+
+
+def _transfer(sender, accept, data, write):
+    """Send data from the app in writes, while a thread receives it from accept()
+
+    :return: (sender stats, seconds until all delivered, latency of each write)
+    """
+    written, delivered = [], []
+
+    def receive():
+        receiver = accept()
+        total = 0
+        while (chunk := receiver.recv()):
+            total += len(chunk)
+            delivered.append((time.monotonic(), total))
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+    start = time.monotonic()
+    sender.start()
+    for offset in range(0, len(data), write):
+        sender.send(data[offset:offset+write])
+        written.append((time.monotonic(), min(offset + write, len(data))))
+    sender.close()      # until FIN ACKnowledged
+    receiver.join()
+    done = delivered[-1][0] - start if delivered else 0.
+    return sender.stats, done, latencies([(t - start, n) for t, n in written],
+                                         [(t - start, n) for t, n in delivered])
+
+
+backends = {'sim': run_sim, 'udp': run_udp, 'listener': run_listener}
+
+
+def bench_sweep(args):
+    """Goodput, retransmission and parity overhead, delivery latency and CPU time over a grid"""
+    rows = []
+    print(f'{"backend":>8} {"N":>5} {"loss":>6} {"PER":>6} {"delay":>6} {"size":>6} {"fec":>4} '
+          f'{"MB/s":>8} {"rtx%":>6} {"fec%":>6} {"p50 ms":>8} {"p99 ms":>8} {"CPU s/MB":>9}')
+    data = os.urandom(args.bytes)
+    for N, loss, per, delay, size, fec in itertools.product(args.N, args.loss, args.per,
+                                                            args.delay, args.size, args.fec):
+        link = Link(loss=loss, corrupt=per, delay=delay, rate=args.rate, seed=args.seed)
+        reverse = Link(loss=loss, corrupt=per, delay=delay, seed=args.seed + 1)
+        cpu = time.process_time()
+        stats, elapsed, lat = backends[args.backend](
+            N, link, reverse, data, args.write or size, size, args.cc, args.sack, fec)
+        cpu = time.process_time() - cpu
+        ideal = -(-len(data) // size) + 1     # DATA packets and FIN
+        row = {
+            'backend': args.backend, 'N': N, 'loss': loss, 'per': per,
+            'delay': delay, 'size': size, 'fec': fec, 'bytes': len(data), 'cc': args.cc or 'fixed',
+            'goodput_MBps': len(data) / elapsed / 1e6 if elapsed else None,
+            'rtx_overhead': (stats.sent - stats.parity_sent) / ideal - 1,
+            'fec_overhead': stats.parity_sent / ideal,
+            'timeouts': stats.timeouts,
+            'latency_p50_ms': percentile(lat, 50) * 1000 if lat else None,
+            'latency_p99_ms': percentile(lat, 99) * 1000 if lat else None,
+            'cpu_s_per_MB': cpu / (len(data) / 1e6),
+        }
+        rows.append(row)
+        print(f'{args.backend:>8} {N:>5} {loss:>6} {per:>6} {delay:>6} {size:>6} {fec:>4} '
+              f'{row["goodput_MBps"] or 0:>8.3f} {row["rtx_overhead"] * 100:>6.1f} '
+              f'{row["fec_overhead"] * 100:>6.1f} '
+              f'{row["latency_p50_ms"] or 0:>8.2f} {row["latency_p99_ms"] or 0:>8.2f} '
+              f'{row["cpu_s_per_MB"]:>9.3f}')
+    return rows
+
+
+def bench_message(args):
+    """Messages/sec and small transfers/sec between threads over localhost UDP:
+    one long-lived entity reused vs. a new entity per transfer
+    """
+    N, count = 64, args.messages
+    listener = gbn.GBNListener(('127.0.0.1', 0), N, 16, link=Link())
+    listener.start()
+    peer = ('127.0.0.1', listener.sock.getsockname()[1])
+    sender = gbn.GBNsend(peer, N, sid=1, seqbits=16, link=Link())
+    sender.start()
+    sender.send_message(b'hello')
+    session = listener.accept()
+    session.recv_message()
+    rows = []
+
+    def measure(op, unit, n, send, receive):
+        receiver = threading.Thread(target=lambda: [receive() for _ in range(n)])
+        start = time.perf_counter()
+        receiver.start()
+        for _ in range(n):
+            send()
+        receiver.join()
+        ops = n / (time.perf_counter() - start)
+        print(f'{op:>36} {ops:>10,.0f} {unit}/s')
+        rows.append({'op': op, 'ops_per_sec': ops})
+
+    for size in (100, 1400, 10000):
+        data = bytes(size)
+        measure(f'{size} B messages, pipelined', 'msgs', count,
+                lambda: sender.send_message(data), session.recv_message)
+
+    def transfer():     # waiting for the FIN ACKnowledged, not for the linger
+        sender.send(bytes(100))
+        sender.close()
+    measure('100 B transfers, entity reused', 'transfers', max(count // 10, 1), transfer,
+            lambda: session.recv() and session.recv())
+    sender.close()
+
+    sid = itertools.count(2)
+
+    def transfer_new():
+        s = gbn.GBNsend(peer, N, sid=next(sid), seqbits=16, link=Link(), linger=0.1)
+        s.start()
+        s.send(bytes(100))
+        s.close()
+
+    def receive_new():
+        s = listener.accept()
+        s.recv() and s.recv()
+    measure('100 B transfers, new entity each', 'transfers', max(count // 10, 1),
+            transfer_new, receive_new)
+    listener.close()
+    return rows
+
+
+benchmarks = {
+    'checksum': bench_checksum,
+    'packet': bench_packet,
+    'seq': bench_seq,
+    'buffer': bench_buffer,
+    'ack': bench_ack,
+    'message': bench_message,
+    'sweep': bench_sweep,
+}
+
+
+def write_results(results, json_path=None, csv_path=None):
+    """Write the result rows, each tagged with its benchmark name, as JSON and/or CSV"""
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'time': time.time(), 'results': results},
+                      f, indent=1)
+    if csv_path:
+        fields = []
+        for row in results:
+            fields += [key for key in row if key not in fields]
+        with open(csv_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fields)
+            writer.writeheader()
+            writer.writerows(results)
+
+
+def parse_args(argv=None):
+    floats = lambda s: [float(x) for x in s.split(',')]
+    ints = lambda s: [int(x) for x in s.split(',')]
+    parser = argparse.ArgumentParser(description='GBN benchmarks')
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help=f'benchmarks to run: {", ".join(benchmarks)}; all but sweep by default')
+    parser.add_argument('--json', help='write the results to a JSON file')
+    parser.add_argument('--csv', help='write the results to a CSV file')
+    parser.add_argument('--messages', type=int, default=2000,
+                        help='messages per size in the message benchmark')
+    sweep = parser.add_argument_group('sweep', 'comma-separated values for a grid')
+    sweep.add_argument('--backend', choices=list(backends), default='sim')
+    sweep.add_argument('--N', type=ints, default=[16, 64])
+    sweep.add_argument('--loss', type=floats, default=[0., 0.01])
+    sweep.add_argument('--per', type=floats, default=[0.])
+    sweep.add_argument('--delay', type=floats, default=[0.001, 0.02], help='one-way, in seconds')
+    sweep.add_argument('--size', type=ints, default=[gbn.MSS], help='payload bytes per packet')
+    sweep.add_argument('--write', type=int, help='bytes per app write, payload size if omitted')
+    sweep.add_argument('--bytes', type=int, default=1000000, help='bytes per transfer')
+    sweep.add_argument('--rate', type=float, help='bandwidth cap in bytes/sec')
+    sweep.add_argument('--cc', choices=['reno', 'cubic'])
+    sweep.add_argument('--sack', action='store_true')
+    sweep.add_argument('--fec', type=ints, default=[0],
+                       help='DATA packets per parity packet, 0 for no FEC')
+    sweep.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in benchmarks:
+            parser.error(f'unknown benchmark: {name}')
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = []
+    for name in args.names or [name for name in benchmarks if name != 'sweep']:
+        print(f'*** {name} ***')
+        for row in benchmarks[name](args):
+            results.append({'bench': name, **row})
+    write_results(results, args.json, args.csv)
@@ -0,0 +1,18 @@
+# Helpers shared by the tests and the benchmarks
+
+import socket
+
+import gbn
+
+
+def free_port():
+    """A UDP port free on localhost, for the entities binding their ports"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class NullSend(gbn.SendFSM):
+    """Sending-side FSM transmitting nowhere"""
+    def transmit(self, buffers, delay=0.):
+        pass
@@ -0,0 +1,136 @@
+# Congestion control policies for GBNsend
+# cwnd in packets, limited by the send window size N
+
+import math
+
+
+class CongestionControl:
+    """Fixed window of N packets: no congestion control
+    """
+    name = 'fixed'
+    fast_retransmit = False     # retransmit on 3 duplicate ACKs
+
+    def __init__(self, N):
+        """
+        :param N: send window size, upper bound of cwnd
+        """
+        self.N = N
+        self.cwnd = N
+        self.ssthresh = N
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(cwnd={self.cwnd:.2f}, ssthresh={self.ssthresh:.2f})'
+
+    def window(self):
+        """Effective window in packets"""
+        return max(1, min(self.N, int(self.cwnd)))
+
+    def on_ack(self, acked, now, srtt=None):
+        """New packets ACKnowledged
+
+        :param acked: number of packets newly ACKnowledged
+        :param now: time.monotonic() when the ACK arrived
+        :param srtt: smoothed RTT(in seconds), None if not yet estimated
+        """
+        pass
+
+    def on_loss(self, flight, now):
+        """Loss detected by duplicate ACKs, once per window
+
+        :param flight: number of packets outstanding
+        """
+        pass
+
+    def on_timeout(self, flight, now):
+        """Retransmit timeout"""
+        pass
+
+
+class Reno(CongestionControl):
+    """Slow start, then AIMD: +1 packet per RTT, halved on loss
+    """
+    name = 'reno'
+    fast_retransmit = True
+    IW = 4      # initial window
+
+    def __init__(self, N):
+        CongestionControl.__init__(self, N)
+        self.cwnd = min(self.IW, N)
+
+    def on_ack(self, acked, now, srtt=None):
+        if self.cwnd < self.ssthresh:   # slow start
+            self.cwnd += acked
+        else:                           # congestion avoidance
+            self.cwnd += acked / self.cwnd
+        self.cwnd = min(self.cwnd, self.N)
+
+    def on_loss(self, flight, now):
+        self.ssthresh = max(flight / 2, 2)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, flight, now):
+        self.ssthresh = max(flight / 2, 2)
+        self.cwnd = 1
+
+
+class Cubic(Reno):
+    """CUBIC window growth(RFC 8312) in congestion avoidance
+    """
+    name = 'cubic'
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, N):
+        Reno.__init__(self, N)
+        self.w_max = 0.             # window just before the last reduction
+        self.epoch_start = None     # start of the current congestion avoidance epoch
+        self.K = 0.
+        self.origin = 0.
+
+    def on_ack(self, acked, now, srtt=None):
+        if self.cwnd < self.ssthresh or srtt is None:
+            Reno.on_ack(self, acked, now, srtt)
+            return
+        if self.epoch_start is None:
+            self.epoch_start = now
+            self.origin = max(self.w_max, self.cwnd)
+            self.K = math.pow(max(self.w_max - self.cwnd, 0.) / self.C, 1 / 3)
+        t = now - self.epoch_start + srtt
+        target = self.origin + self.C * (t - self.K) ** 3
+        # TCP-friendly region: at least what Reno would have by now
+        w_est = self.w_max * self.BETA + 3 * (1 - self.BETA) / (1 + self.BETA) * (t / srtt)
+        target = max(target, w_est)
+        if target > self.cwnd:
+            self.cwnd += (target - self.cwnd) / self.cwnd * acked
+        else:
+            self.cwnd += 0.01 * acked / self.cwnd
+        self.cwnd = min(self.cwnd, self.N)
+
+    def on_loss(self, flight, now):
+        # fast convergence: release bandwidth sooner if the window keeps shrinking
+        if self.cwnd < self.w_max:
+            self.w_max = self.cwnd * (1 + self.BETA) / 2
+        else:
+            self.w_max = self.cwnd
+        self.cwnd = self.ssthresh = max(self.cwnd * self.BETA, 2)
+        self.epoch_start = None
+
+    def on_timeout(self, flight, now):
+        self.w_max = self.cwnd
+        self.ssthresh = max(self.cwnd * self.BETA, 2)
+        self.cwnd = 1
+        self.epoch_start = None
+
+
+policies = {policy.name: policy for policy in (CongestionControl, Reno, Cubic)}
+
+
+def create(cc, N):
+    """Congestion control object of the policy
+
+    :param cc: policy name('fixed', 'reno', 'cubic'), CongestionControl object, or None for 'fixed'
+    :param N: send window size
+    """
+    if isinstance(cc, CongestionControl):
+        return cc
+    return policies[cc or 'fixed'](N)
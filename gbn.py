@@ -1,12 +1,20 @@
 # TCP-like GBN protocol implementation
 # with N(>=1) receive window size
+# Requires Python 3.8 or later(assignment expressions, multiprocessing.shared_memory)
 
-import socket, select, threading, queue, time, copy, random, logging
+import socket, selectors, threading, queue, time, copy, logging, heapq, io, os, mmap, itertools, \
+    zlib
+from collections import deque
 from enum import Enum, IntEnum, auto
 
-from packet import Seq, srange, Type, Packet, PacketBuffer
+from packet import seqclass, srange, Type, Opt, Packet, PacketBuffer, BufferPool, \
+    Parity, ichecksum, parse_header
+import congestion
+from netem import Link
+from metrics import Statistics
 
-# Parameters for simulating noisy network environment
+# Parameters for simulating noisy network environment,
+# by default when opening entities without their own netem.Link
 PER = 0.1               # packet error rate
 LOSSRATE = 0.1          # packet loss rate
 EXTRA_MEAN_DELAY = 0    # extra exponential-variate mean delay(in seconds)
@@ -21,14 +29,46 @@ class Ev(IntEnum):      # events
     TO_Retransmit   = 32
     TO_Closing      = 33
     TO_DelayedACK   = 34
+    TO_Flush        = 35
+    TO_Persist      = 36
+    TO_Linger       = 37
+
+LINGER = 2              # seconds a closed sender stays, for the late ACKs and the next transfer
+LINGER_MARGIN = 1       # seconds a closing receiver outlasts it, for the packets in flight
 
 # initial timeout interval
 TO_interval= {
     Ev.TO_Retransmit: 0.3 + 5 * EXTRA_MEAN_DELAY,
-    Ev.TO_Closing: 1,
-    Ev.TO_DelayedACK: 0.5
+    Ev.TO_Closing: LINGER + LINGER_MARGIN,
+    Ev.TO_DelayedACK: 0.04,
+    Ev.TO_Flush: 0.01,
+    Ev.TO_Persist: 0.2,
+    Ev.TO_Linger: LINGER
               }
 
+MSS = 1400              # max payload bytes in a DATA packet
+RCV_BUFSIZE = 2048      # bytes of each receive buffer: larger packets arrive cut short
+# largest mss: a DATA packet with all its header options fits a receive buffer,
+# and so does its parity packet, 4 bytes longer
+MAX_MSS = RCV_BUFSIZE - 4 - len(Packet(Type.DATA, seqclass(32)(0),
+                                       options={Opt.SID: bytes(4), Opt.ZIP: bytes(1)}).hdr)
+MAX_BATCH = 64          # max packets received per wakeup
+
+MAX_SACK_BLOCKS = 16   # in an ACK
+FEC_MAX_BLOCK = 64      # DATA packets per parity packet, and delivered ones kept to rebuild
+
+# compression of the data: codec id in Opt.ZIP, app bytes compressed per flush,
+# and per check whether compression pays, saving at least ZIP_MIN_SAVING of them
+ZIP_ZLIB = 1
+ZIP_CHUNK = 65536
+ZIP_PROBE = 65536
+ZIP_MIN_SAVING = 0.1
+
+# bounds of the adaptive retransmit timeout(in seconds)
+RTO_MIN = 0.05          # above TO_DelayedACK of the peer
+RTO_MAX = 10
+MAX_RETRIES = 12        # timeouts in a row, without an ACK moving the window, before giving up
+
 
 class State(Enum):   # States
     Wait    = auto()
@@ -36,69 +76,591 @@ class State(Enum):   # States
     Closed  = auto()
 
 
-def open(peer_host, N, passive=False):
+def open(peer_host, N, passive=False, sid=None, seqbits=8, sack=False, cc=None,
+         delayed_ack=True, mss=MSS, link=None, queue_bytes=None, fec=0, compress=0, linger=None):
     """Open GBN protocol entity
 
     :param peer_host: peer host name
     :param passive: for sending (default), for receiving if True
+    :param sid: session id for sending to a GBNListener; the sender then
+                binds an ephemeral port, so many senders can run on a host
+    :param seqbits: sequence number width: 8, 16 or 32.
+                    The receiver follows the width the sender uses.
+    :param sack: for sending, ask for selective ACKs to retransmit only the holes.
+                 Receivers always support them.
+    :param cc: for sending, congestion control policy: 'reno', 'cubic' or
+               a congestion.CongestionControl object; fixed window N if None
+    :param delayed_ack: for receiving, ACK every second packet or on TO_DelayedACK
+    :param mss: for sending, max payload bytes in a DATA packet, up to MAX_MSS
+    :param link: netem.Link emulating the outgoing direction; by PER, LOSSRATE and
+                 EXTRA_MEAN_DELAY if None
+    :param queue_bytes: bytes the send queue, or the receive buffer, holds
+                        before blocking the app or closing the window; N * mss by default
+    :param fec: for sending, a parity packet every fec DATA packets, from which the receiver
+                rebuilds one lost packet of the block without retransmission; 0 for none.
+                Receivers always support it.
+    :param compress: for sending, zlib level(1-9) compressing the data once the receiver
+                     agrees, switched off when it does not pay; 0 for none.
+                     Receivers always support it.
+    :param linger: seconds the sender stays after a transfer is closed, for the late packets
+                   and for the next transfer reusing it, LINGER if None. The receiver stays
+                   LINGER_MARGIN longer; give both sides the same value.
     :return: GBN thread object
     """
-    assert N < Seq.MOD, "N: too big"
+    assert N <= seqclass(seqbits).HALF, "N: too big"
     if passive:
-        gbn = GBNrecv((peer_host, sender_port), N)
+        gbn = GBNrecv((peer_host, sender_port), N, seqbits, delayed_ack, link, queue_bytes,
+                      linger=linger)
         gbn.start()
         logging.info('app receiver starts')
     else:
-        gbn = GBNsend((peer_host, receiver_port), N)
+        gbn = GBNsend((peer_host, receiver_port), N, sid, seqbits, sack, cc, mss, link,
+                      queue_bytes, fec=fec, compress=compress, linger=linger)
         gbn.start()
         logging.info('app sender starts')
     return gbn
 
 
-class Statistics:
-    """statistics about packet exchange
+def listen(N, port=receiver_port, seqbits=8, delayed_ack=True, link=None, linger=None,
+           queue_bytes=None):
+    """Open GBN listener receiving many sessions on one UDP port
+
+    :param N: receive window size of each session
+    :param port: UDP port to listen on
+    :param seqbits: sequence number width of the sessions
+    :param delayed_ack: whether the sessions delay ACKs
+    :param link: netem.Link shared by the sessions for their ACKs
+    :param linger: seconds the senders linger after closing, LINGER if None;
+                   the sessions stay LINGER_MARGIN longer
+    :param queue_bytes: bytes the receive buffer of each session holds
+                        before its window closes, N * MSS by default
+    :return: GBNListener thread object; accept() returns its sessions
     """
-    def __init__(self):
-        self.sent = self.dropping = self.corrupting = 0   # for packet transmission
-        self.rcvd = self.corrupt = 0    # for packets reception
-        self.elapsed = None
+    assert N <= seqclass(seqbits).HALF, "N: too big"
+    listener = GBNListener(('', port), N, seqbits, delayed_ack, link, linger, queue_bytes)
+    listener.start()
+    logging.info('app listener starts')
+    return listener
+
+
+_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
 
-    def __str__(self):
-        return f"""Packets sent: {self.sent} (dropping: {self.dropping}, corrupting: {self.corrupting})
-Packets rcvd: {self.rcvd} (corrupt: {self.corrupt})
-Time elapsed: {self.elapsed} sec"""
+
+def sendmsg(sock, buffers, addr=None):
+    """Send the buffers as one datagram, gathering them without joining if possible"""
+    if hasattr(sock, 'sendmsg'):
+        if addr is None:
+            sock.sendmsg(buffers)
+        else:
+            sock.sendmsg(buffers, (), 0, addr)
+    elif addr is None:      # no sendmsg on Windows
+        sock.send(b''.join(buffers))
+    else:
+        sock.sendto(b''.join(buffers), addr)
+
+
+def size_buffers(sock, nbytes):
+    """Enlarge the socket receive/send buffers to nbytes, never shrinking them
+    Note: the OS may cap the size(net.core.rmem_max/wmem_max in Linux).
+    """
+    for opt in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        try:
+            if sock.getsockopt(socket.SOL_SOCKET, opt) < nbytes:
+                sock.setsockopt(socket.SOL_SOCKET, opt, nbytes)
+        except OSError:
+            pass
+
+
+def map_region(nbytes):
+    """Size of a mapped file region holding nbytes, aligned for mmap offsets"""
+    gran = mmap.ALLOCATIONGRANULARITY
+    return max(-(-nbytes // gran) * gran, gran)
+
+
+class ByteQueue:
+    """FIFO queue between the app and the protocol threads, bounded by bytes
+    Items are data chunks, or markers(None, b'', Source, FileSink, ...) counting as no bytes.
+    A batch taken by get_many ends at a marker, so the consumer handles it in order.
+    """
+    def __init__(self, limit=None, wakeup=None):
+        """
+        :param limit: max bytes queued, unbounded if None.
+                      A larger chunk still goes into an empty queue.
+        :param wakeup: callback when the queue becomes non-empty,
+                       for a consumer not waiting on the queue itself
+        """
+        self.items = deque()
+        self.nbytes = 0
+        self.limit = limit
+        self.wakeup = wakeup
+        self.shut = False   # no more items taken, after shutdown()
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+
+    def __len__(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+    @staticmethod
+    def size(item):
+        """Bytes of a data chunk, 0 for a marker"""
+        return len(item) if isinstance(item, (bytes, bytearray, memoryview)) else 0
+
+    def put(self, item, timeout=None):
+        """Put an item, waiting for room
+
+        :param timeout: seconds to wait, forever if None
+        :raise queue.Full: if timed out
+        """
+        self.put_many((item,), timeout)
+
+    def put_many(self, items, timeout=None):
+        """Put the items in order, waiting for room as needed
+
+        :param timeout: seconds to wait in total, forever if None
+        :raise queue.Full: if timed out; the items before have been queued
+        :raise ConnectionError: if shut down
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.mutex:
+            if self.shut:
+                raise ConnectionError('the consumer has ended')
+            for item in items:
+                size = self.size(item)
+                while size and self.items and self.limit is not None \
+                        and self.nbytes + size > self.limit:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise queue.Full
+                    self.not_full.wait(remaining)
+                    if self.shut:
+                        raise ConnectionError('the consumer has ended')
+                self.items.append(item)
+                self.nbytes += size
+                self.not_empty.notify()
+                if len(self.items) == 1 and self.wakeup:    # after appending, not to be missed
+                    self.wakeup()
+
+    def shutdown(self, discard=False):
+        """Refuse any more items, if none are left for the consumer
+
+        :param discard: drop the items left, shutting down anyway
+        :return: True if shut down, False if items are queued
+        """
+        with self.mutex:
+            if self.items and not discard:
+                return False
+            self.items.clear()
+            self.nbytes = 0
+            self.shut = True
+            self.not_full.notify_all()
+            return True
+
+    def close(self):
+        """Shut down for good, whatever is left
+
+        :return: list of the items left, for the consumer to dispose of
+        """
+        with self.mutex:
+            items = list(self.items)
+            self.items.clear()
+            self.nbytes = 0
+            self.shut = True
+            self.not_full.notify_all()
+            return items
+
+    def get(self, timeout=None):
+        """Remove and return the oldest item, waiting for one
+
+        :param timeout: seconds to wait, forever if None; 0 not to wait
+        :raise queue.Empty: if timed out
+        """
+        with self.not_empty:
+            if not self.not_empty.wait_for(lambda: self.items, timeout):
+                raise queue.Empty
+            item = self.items.popleft()
+            self.nbytes -= self.size(item)
+            self.not_full.notify_all()
+            return item
+
+    def get_many(self, max_bytes=None, timeout=None):
+        """Remove and return the oldest items, waiting for at least one
+
+        :param max_bytes: max bytes of the chunks taken after the first one, no limit if None
+        :param timeout: seconds to wait, forever if None; 0 not to wait
+        :return: list of the items, ending at the first marker if any
+        :raise queue.Empty: if timed out
+        """
+        with self.not_empty:
+            if not self.not_empty.wait_for(lambda: self.items, timeout):
+                raise queue.Empty
+            items, batch, nbytes = self.items, [], 0
+            while items:
+                item = items[0]
+                if not isinstance(item, (bytes, bytearray, memoryview)):
+                    if not batch:
+                        batch.append(items.popleft())
+                    break
+                if batch and max_bytes is not None and nbytes + len(item) > max_bytes:
+                    break
+                batch.append(items.popleft())
+                nbytes += len(item)
+            self.nbytes -= nbytes
+            self.not_full.notify_all()
+            return batch
+
+
+class StreamBuffer:
+    """In-order received data collected into one bytearray, read as a byte stream
+    The receiving FSM writes into it as its sink; b'' marks the end of data,
+    and EOM the end of a message.
+    The free space is advertised to the sender as the receive window.
+    Data of the next transfer over the entity may follow the end of data:
+    reading b'' consumes it, and reads wait for the next transfer until finish().
+    """
+    def __init__(self, limit, opened=None):
+        """
+        :param limit: bytes the buffer holds before the window closes
+        :param opened: callback when reading opens the window by half the limit or more
+                       beyond the last advertised, for a window update
+        """
+        self.buf = bytearray()
+        self.start = 0          # next byte to read in buf
+        self.limit = limit
+        self.want = 0           # bytes a reader waits for, even beyond the limit
+        self.advertised = limit     # free bytes last advertised
+        self.opened = opened
+        self.consumed = 0       # bytes read in total, the stream offset of buf[start]
+        self.ends = deque()     # stream offsets of the ends of messages
+        self.eofs = deque()     # stream offsets of the ends of data, one per transfer
+        self.finished = False   # no more transfers, the entity has ended
+        self.cond = threading.Condition()
+
+    def __len__(self):
+        return len(self.buf) - self.start
+
+    @property
+    def eof(self):
+        """Whether the data end at the head, the next read returning b''"""
+        if self.eofs:
+            return self.eofs[0] == self.consumed
+        return self.finished and not len(self)
+
+    def window(self):
+        """Free bytes to advertise to the sender"""
+        with self.cond:
+            self.advertised = max(max(self.limit, self.want) - len(self), 0)
+            return self.advertised
+
+    def write(self, data):
+        """Append data, b'' at the end of data, or EOM at the end of a message"""
+        with self.cond:
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                if data:
+                    self.buf += data
+                else:
+                    self.eofs.append(self.consumed + len(self))
+            elif data is EOM:
+                self.ends.append(self.consumed + len(self))
+            self.cond.notify_all()
+
+    def finish(self):
+        """Mark that no more data are coming, reads returning b'' after the data"""
+        with self.cond:
+            self.finished = True
+            self.cond.notify_all()
+
+    def read(self, max_bytes=None, timeout=None):
+        """Read up to max_bytes, all the data ready if None
+
+        :return: bytes, b'' at the end of data
+        :raise queue.Empty: if timed out
+        """
+        with self.cond:
+            self._wait(1, timeout)
+            n = self._ready() if max_bytes is None else min(self._ready(), max_bytes)
+            if not n:
+                self._end()
+                return b''
+            with memoryview(self.buf) as view:
+                data = bytes(view[self.start:self.start+n])
+            self._consume(n)
+            return data
+
+    def readinto(self, buffer, timeout=None):
+        """Read into a writable bytes-like buffer
+
+        :return: number of bytes read, 0 at the end of data
+        :raise queue.Empty: if timed out
+        """
+        target = memoryview(buffer).cast('B')
+        with self.cond:
+            self._wait(1, timeout)
+            n = min(self._ready(), len(target))
+            if not n:
+                self._end()
+                return 0
+            with memoryview(self.buf) as view:
+                target[:n] = view[self.start:self.start+n]
+            self._consume(n)
+            return n
+
+    def readexactly(self, n, timeout=None):
+        """Read exactly n bytes, opening the window beyond the limit if needed
+
+        :raise EOFError: if the data end first; the bytes read are left in the buffer
+        :raise queue.Empty: if timed out
+        """
+        with self.cond:
+            self.want = n
+            self._update()
+            try:
+                self._wait(n, timeout)
+            finally:
+                self.want = 0
+            if self._ready() < n:
+                raise EOFError(f'{self._ready()} bytes left, {n} expected')
+            with memoryview(self.buf) as view:
+                data = bytes(view[self.start:self.start+n])
+            self._consume(n)
+            return data
+
+    def read_message(self, timeout=None):
+        """Read the next message whole, opening the window beyond the limit for a large one
+
+        :return: bytes, the rest of the data if they end without the end of a message,
+                 b'' at the end of data
+        :raise queue.Empty: if timed out
+        """
+        with self.cond:
+            try:
+                if not self.cond.wait_for(self.message_ready, timeout):
+                    raise queue.Empty
+            finally:
+                self.want = 0
+            n = self._ready()
+            if self.ends and self.ends[0] - self.consumed <= n:
+                n = self.ends.popleft() - self.consumed
+            if not n:
+                self._end()
+                return b''
+            with memoryview(self.buf) as view:
+                data = bytes(view[self.start:self.start+n])
+            self._consume(n)
+            return data
+
+    def ready(self, n=1):
+        """Whether n bytes, or the end of data, can be read without waiting"""
+        return len(self) >= n or bool(self.eofs) or self.eof
+
+    def message_ready(self):
+        """Whether the next message can be read whole without waiting;
+        if not, the window opens beyond the limit for a message larger than the buffer
+        """
+        if self.ends or self.eofs or self.eof:
+            return True
+        if len(self) >= max(self.limit, self.want):
+            self.want = len(self) + self.limit
+            self._update()
+        return False
+
+    def move_to(self, sink):
+        """Move the data up to the end of data into the sink, the receiving FSM switching to it
+
+        :return: whether the data end here, leaving nothing more for the sink
+        """
+        with self.cond:
+            n = self._ready()
+            if n:
+                with memoryview(self.buf) as view:
+                    sink.write(view[self.start:self.start+n])
+                self._consume(n)
+            return bool(self.eofs)
+
+    def _ready(self):
+        """Bytes to read before the next end of data"""
+        return self.eofs[0] - self.consumed if self.eofs else len(self)
+
+    def _end(self):
+        """Consume the end of data at the head"""
+        if self.eofs and self.eofs[0] == self.consumed:
+            self.eofs.popleft()
+
+    def _wait(self, n, timeout):
+        if not self.cond.wait_for(lambda: self.ready(n), timeout):
+            raise queue.Empty
+
+    def _consume(self, n):
+        """Drop n bytes read from the head, compacting the buffer lazily"""
+        self.consumed += n
+        while self.ends and self.ends[0] <= self.consumed:     # read through by read()
+            self.ends.popleft()
+        self.start += n
+        if self.start == len(self.buf):
+            self.buf.clear()
+            self.start = 0
+        elif self.start > len(self.buf) // 2:
+            del self.buf[:self.start]
+            self.start = 0
+        self._update()
+
+    def _update(self):
+        """Request a window update if the window has opened enough"""
+        free = max(self.limit, self.want) - len(self)
+        if self.opened and free - self.advertised >= self.limit // 2:
+            self.advertised = free
+            self.opened()
+
+
+class Message(bytes):
+    """App data sent as one message, its last segment flagged with Type.PSH
+    The receiving app gets it whole by recv_message().
+    """
+
+
+EOM = object()  # marker of the end of a message, delivered after its data
+
+
+class Source:
+    """Data sent in place, sliced into packets without copying, like a mapped file region
+    Note: the buffer must not change until done() is called,
+        when all of the data are ACKnowledged.
+    """
+    def __init__(self, buffer, done=None):
+        """
+        :param buffer: bytes-like object
+        :param done: callback when all ACKnowledged, called in the protocol thread
+        """
+        self.view = memoryview(buffer)
+        self.offset = 0     # next byte to packetize
+        self.done = done
+
+    def __repr__(self):
+        return f'Source({self.offset}/{len(self.view)})'
+
+
+class FileSink:
+    """Received data written into a file through mmap, a region at a time
+    """
+    def __init__(self, path, region, progress=None):
+        """
+        :param path: file path, created or truncated
+        :param region: mapped region size, a multiple of mmap.ALLOCATIONGRANULARITY
+        :param progress: callback taking bytes written so far, whenever a region is mapped
+        """
+        self.file = io.open(path, 'w+b')
+        self.region = region
+        self.progress = progress
+        self.mm = None
+        self.mapped = 0     # file offset where the current region ends
+        self.pos = 0        # write position in the current region
+        self.done = threading.Event()   # set when the receiving FSM stops writing into it
+
+    def __repr__(self):
+        return f'FileSink({self.file.name!r}, {self.size})'
+
+    @property
+    def size(self):
+        """Bytes written so far"""
+        return self.mapped - len(self.mm) + self.pos if self.mm is not None else 0
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self.mm is None or self.pos == len(self.mm):
+                self._map_next()
+            n = min(len(view), len(self.mm) - self.pos)
+            self.mm[self.pos:self.pos+n] = view[:n]
+            self.pos += n
+            view = view[n:]
+
+    def _map_next(self):
+        if self.mm is not None:
+            self.mm.close()
+            if self.progress:
+                self.progress(self.mapped)
+        fd = self.file.fileno()
+        os.ftruncate(fd, self.mapped + self.region)
+        self.mm = mmap.mmap(fd, self.region, offset=self.mapped)
+        self.mapped += self.region
+        self.pos = 0
+
+    def close(self):
+        """Unmap, then cut the file to the bytes written"""
+        size = self.size
+        if self.mm is not None:
+            self.mm.close()
+        self.file.truncate(size)
+        self.file.close()
+        if self.progress:
+            self.progress(size)
 
 
 class Timer:
     """Non-threaded Timer supporting multiple timeouts
+    Note: a min-heap of (time to expire, key) on the clock, time.monotonic() by default.
+        Restarting or stopping a timer leaves its old heap entry behind,
+        which is discarded when it comes to the top (lazy cancellation).
     """
-    def __init__(self, intv:dict=TO_interval):
-        self.times = {}
-        # default timeout interval
-        self.intv = intv
+    def __init__(self, intv:dict=TO_interval, clock=time.monotonic):
+        """
+        :param intv: timeout interval of each event
+        :param clock: function returning the current time in seconds, like a virtual clock
+        """
+        self.clock = clock
+        self.times = {}     # key -> time to expire
+        self.heap = []      # (time to expire, key), including stale entries
+        # default timeout interval, copied not to share set_intv among Timers
+        self.intv = dict(intv)
 
     def start_timer(self, key:Ev):
-        self.times[key] = time.time() + self.intv[key]  # time to expire
+        """Start the timer, restarting it if running"""
+        t = self.clock() + self.intv[key]  # time to expire
+        self.times[key] = t
+        heapq.heappush(self.heap, (t, key))
+        if len(self.heap) > 4 * len(self.times) + 16:   # too many stale entries
+            self.heap = [(t, key) for key, t in self.times.items()]
+            heapq.heapify(self.heap)
 
     def stop_timer(self, key:Ev):
         if key in self.times:
             del self.times[key]
 
+    def running(self, key:Ev):
+        """Whether the timer is running"""
+        return key in self.times
+
+    def _top(self):
+        """Discard stale entries on the top of the heap"""
+        heap, times = self.heap, self.times
+        while heap and times.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
     def check_timeout(self):
         """Check if timeout occurs
-        Note: invoke this method periodically
+        Note: invoke this method periodically, or when next_deadline passes
 
         :return: timeout event type if any
                  None, otherwise
         """
-        now = time.time()
-        sorted_items = sorted(self.times.items(), key=lambda x: x[1])
-        for i, (key, t) in enumerate(sorted_items):
-            if t <= now:
-                del self.times[key]
-                return key
-        else:
+        top = self._top()
+        if top is None or top[0] > self.clock():
             return None
+        heapq.heappop(self.heap)
+        del self.times[top[1]]
+        return top[1]
+
+    def next_deadline(self):
+        """Earliest expiry time among the running timers
+
+        :return: deadline on the clock, None if no timer is running
+        """
+        top = self._top()
+        return None if top is None else top[0]
 
     def set_intv(self, key:Ev, intv):
         """Set new timeout interval"""
@@ -112,11 +674,999 @@ class Timer:
         return self.intv[key]
 
 
-# GBN abstract super class running in a thread
-class GBN(threading.Thread):
-    def __init__(self, peer):
+# GBN protocol entity, independent of how it is driven
+# (by a thread in this module, or by an asyncio event loop in aiogbn)
+class Entity:
+    def __init__(self, N, timer=None, sid=None, seqbits=8, link=None):
         """
         :param N: (send or receive) buffer size
+        :param timer: Timer object generating timeout events
+        :param sid: session id carried in every packet if not None
+        :param seqbits: sequence number width
+        :param link: netem.Link emulating the outgoing direction,
+                     by PER, LOSSRATE and EXTRA_MEAN_DELAY if None
+        """
+        self.N = N     # buffer size
+        self.sid = sid
+        self.state = State.Wait
+        self.base = seqclass(seqbits)(0)
+        self.stats = Statistics()
+        self.trace = None   # metrics.Trace recording the events, if any
+        self.timer = Timer() if timer is None else timer
+        self.clock = self.timer.clock
+        if link is None:
+            link = Link(loss=LOSSRATE, corrupt=PER, jitter=EXTRA_MEAN_DELAY)
+        self.link = link
+
+    # lower layer(UDT) interface complying with the textbook
+    def udt_send(self, packet: Packet):
+        """Unreliable data transfer via the transport
+        to simulate noisy, lossy, and random delayed network environment
+        """
+        self.stats.sent += 1
+        copies = self.link.emulate(len(packet), self.clock())
+        if not copies:  # enforce loss
+            self.stats.dropping += 1
+            logging.info('udt_send: [dropping] %s', packet)
+            return
+        for delay, corrupt in copies:   # delivered after the delay
+            if corrupt:     # enforce bit error
+                pdu = copy.copy(packet.pdu)  # deep copy for emulating bit errors
+                i = self.link.rng.randrange(len(pdu))
+                pdu[i] = pdu[i] ^ 1  # XOR, enforce bit error
+                self.transmit([pdu], delay)
+                self.stats.corrupting += 1
+                if logging.getLogger().isEnabledFor(logging.INFO):
+                    logging.info('udt_send: [corrupting] %s', Packet(pdu))
+            else:
+                self.transmit(packet.buffers, delay)
+                logging.debug('udt_send: %s', packet)
+
+    def make_pkt(self, type, seq, data=b'', options=None):
+        """Make a packet with this session's header options, and the given ones"""
+        if self.sid is not None:
+            options = dict(options or {})
+            options[Opt.SID] = self.sid.to_bytes(4, 'big')
+        return Packet(type, seq, data, options)
+
+    def make_rcvpkt(self, pdu):
+        """Make a Packet object from the received pdu, counting it"""
+        return self.received(Packet(pdu))
+
+    def received(self, packet):
+        """Count the received packet"""
+        self.stats.rcvd += 1
+        if packet.corrupt():
+            self.stats.corrupt += 1
+        return packet
+
+    # delegate implementation to transports
+    def transmit(self, buffers, delay=0.):
+        """Hand the packet buffers to the transport after delay(in seconds)"""
+        raise NotImplementedError
+
+    def deliver(self, data):
+        raise NotImplementedError
+
+    # delegate implementation to subclasses for providing same interface
+    def _log(self, event='', chunk=''):
+        raise NotImplementedError
+
+    def transition(self, event, chunk=''):
+        """Run the FSM for an event
+
+        :param event: Ev.Packet_Arrival, Ev.App_Request or a timeout event
+        :param chunk: received Packet for Ev.Packet_Arrival, app data for Ev.App_Request
+        """
+        raise NotImplementedError
+
+
+# GBN Sending-side FSM
+class SendFSM(Entity):
+    def __init__(self, N, timer=None, sid=None, seqbits=8, sack=False, cc=None, mss=MSS,
+                 link=None, fec=0, compress=0):
+        """GBN sending-side
+
+        :param N:    send window size
+        :param sid:  session id, if any
+        :param seqbits: sequence number width
+        :param sack: ask the receiver for selective ACKs
+        :param cc: congestion control policy name or object, fixed window if None
+        :param mss: max payload bytes in a DATA packet
+        :param link: netem.Link emulating the path to the receiver
+        :param fec: DATA packets per parity packet, 0 for no FEC
+        :param compress: zlib level compressing the data once the receiver answers
+                         with Type.ZIP, 0 for none
+        """
+
+        assert 0 <= fec <= FEC_MAX_BLOCK, "fec: too big"
+        assert 0 < mss <= MAX_MSS, "mss: too big for the receive buffers"
+        Entity.__init__(self, N, timer, sid, seqbits, link)
+        self.sndbuf = PacketBuffer(self.N, self.base)
+        self.next_seq = self.base
+        # RTO estimation(RFC 6298) from the ACK timing
+        self.sent_time = {}     # seq -> time first sent, only for packets not retransmitted
+        self.srtt = self.rttvar = None
+        self.rto = self.timer.get_intv(Ev.TO_Retransmit)
+        self.rtx_time = None    # time of the last timeout retransmission not yet ACKnowledged
+        # selective repeat, once the receiver answers with Type.SACK
+        self.sack = sack
+        self.sack_ok = False
+        self.sacked = 0         # bit i is set if base + i is selectively ACKnowledged
+        # forward error correction, once the receiver answers with Type.PARITY
+        self.fec = fec
+        self.fec_ok = False
+        self.parity = None      # Parity of the new DATA packets in the current block
+        # congestion control: effective window cwnd <= N
+        self.cc = congestion.create(cc, N)
+        self.dupacks = 0
+        self.recover = None     # next_seq when fast retransmit started, until ACKnowledged
+        self.rtx_next = None    # next seq to go back and retransmit after timeout
+        self.retries = 0        # timeouts in a row, without an ACK moving the window
+        self.failed = False     # the peer stopped answering, closed after MAX_RETRIES
+        # byte stream not yet packetized, split at mss or merged up to it
+        self.mss = mss
+        self.sndq = bytearray()
+        self.sndq_limit = N * mss
+        self.sndq_times = deque()   # (bytes written in total, time) of the writes in sndq
+        self.sndq_in = self.sndq_out = 0    # bytes written to and taken from sndq
+        self.msg_ends = deque()     # sndq_in at the ends of the messages in sndq
+        self.flush_due = False  # send a partial segment without waiting for ACKs
+        self.fin_pending = False
+        # compressed stream, once the receiver answers with Type.ZIP
+        self.compress = compress    # zlib level, 0 when switched off
+        self.zipper = None      # zlib compressor
+        self.zipq = bytearray()     # compressed data not yet packetized
+        self.zipq_out = 0           # bytes taken from zipq
+        self.zipq_ends = deque()    # offsets in zipq, like msg_ends, of the ends of messages
+        self.zipq_chunks = deque()  # (start, end offsets in zipq, app bytes) of the chunks in zipq
+        self.zipq_started = 0       # zipq_chunks whose first segment has been sent
+        self.zipq_app = 0           # app bytes of the chunks not yet started
+        self.zip_in = self.zip_out = 0      # bytes in and out since the last check
+        self.zip_cpu = 0.       # CPU seconds compressing them
+        # data sent in place, after the stream buffer
+        self.sources = deque()          # Source objects to packetize
+        self.sources_sent = deque()     # (seq after the last packet, done callback)
+        # flow control: seq beyond the receive window advertised, None if not advertised
+        self.wnd_edge = None
+        self.persist_intv = self.timer.get_intv(Ev.TO_Persist)  # first probe interval
+        # and in app bytes, against which the data compressed are counted:
+        # a chunk may be all delivered from its first segment on, but surely only from its last
+        self.app_edge = None
+        self.app_sent = 0           # app bytes the DATA packets sent may deliver
+        self.app_sure = 0           # app bytes they surely deliver
+        self.app_marks = deque()    # (seq, app_sure after it) of the DATA packets outstanding,
+                                    # while compressing
+        self.app_acked = 0          # app_sure after the last DATA packet ACKnowledged
+
+    # Wrapper methods used in FSM
+    def window_open(self):
+        """Whether the send window has room for a new packet"""
+        return self.rtx_next is None and self.next_seq < (self.base + self.cc.window()) \
+            and (self.wnd_edge is None or self.next_seq < self.wnd_edge)
+
+    def buffer_open(self):
+        """Whether the send buffer has room for more data from the app;
+        never while closing, the next transfer waiting until closed
+        """
+        return self.state != State.Closing and not (self.fin_pending or self.sources) \
+            and len(self.sndq) < self.sndq_limit
+
+    def push(self):
+        """Packetize the send buffer as far as the window allows
+
+        Full segments go out at once. A partial one goes out only when nothing
+        is in flight(Nagle's algorithm), on flush, or when TO_Flush expires.
+        Segments are cut at the end of each message, flagged with Type.PSH,
+        and go out without waiting.
+        With compression, what would go out is compressed, up to ZIP_CHUNK,
+        and the compressed data go out in segments flagged with Type.ZIP.
+        Then Source data are sliced into packets in place.
+        After all the data, FIN goes out if the app has closed.
+        """
+        sndq, mss, sources, zipq = self.sndq, self.mss, self.sources, self.zipq
+        while (zipq or sndq or sources) and self.window_open():
+            if zipq:
+                n, type = self.segment(len(zipq), mss, self.zipq_out, self.zipq_ends)
+                chunks, end, app, sure = self.zipq_chunks, self.zipq_out + n, 0, 0
+                for start, _, size in itertools.islice(chunks, self.zipq_started, None):
+                    if start >= end:
+                        break
+                    app += size     # started in this segment
+                    self.zipq_started += 1
+                while chunks and chunks[0][1] <= end:
+                    sure += chunks.popleft()[2]     # ended in this segment
+                    self.zipq_started -= 1
+                self.zipq_app -= app
+                self.send_packet(type | Type.ZIP, bytes(zipq[:n]), app, sure)
+                del zipq[:n]
+                self.zipq_out += n
+                continue
+            if sndq:
+                if len(sndq) < mss and not (self.flush_due or self.msg_ends) \
+                        and self.base != self.next_seq:
+                    if not self.timer.running(Ev.TO_Flush):
+                        self.timer.start_timer(Ev.TO_Flush)
+                    return
+                if self.zipper is not None:
+                    limit = ZIP_CHUNK
+                    if self.app_edge is not None:   # what the receive window takes
+                        limit = min(limit, self.app_edge - self.app_sent - self.zipq_app)
+                        if limit <= 0 or limit < min(len(sndq), ZIP_CHUNK // 4) \
+                                and self.base != self.next_seq:     # no tiny chunks
+                            break
+                    n, type = self.segment(len(sndq), limit, self.sndq_out, self.msg_ends)
+                    start = self.zipq_out + len(zipq)
+                    self.deflate(sndq[:n])
+                    self.zipq_chunks.append((start, self.zipq_out + len(zipq), n))
+                    self.zipq_app += n
+                    if type & Type.PSH:
+                        self.zipq_ends.append(self.zipq_out + len(zipq))
+                    self.dequeued(n)
+                    del sndq[:n]
+                    continue
+                n, type = self.segment(len(sndq), mss, self.sndq_out, self.msg_ends)
+                self.send_packet(type, bytes(sndq[:n]))
+                self.dequeued(n)
+                del sndq[:n]
+                continue
+            src = sources[0]
+            if src.offset < len(src.view):
+                data = src.view[src.offset:src.offset+mss]
+                self.send_packet(Type.DATA, data)
+                self.stats.app_bytes += len(data)
+                src.offset += mss
+            if src.offset >= len(src.view):
+                sources.popleft()
+                if src.done:
+                    self.sources_sent.append((self.next_seq, src.done))
+        if zipq or sndq or sources:
+            self.persist()
+            return
+        self.flush_due = False
+        self.timer.stop_timer(Ev.TO_Flush)
+        if self.fin_pending and self.window_open():     # end of data
+            self.fin_pending = False
+            if self.parity is not None:     # for the last partial block
+                self.send_parity()
+            self.send_packet(Type.FIN)
+            self.state = State.Closing
+        elif self.fin_pending:
+            self.persist()
+
+    def segment(self, size, limit, offset, ends):
+        """Length and type of the next segment: up to limit bytes, cut at the end of a message
+
+        :param size: bytes queued
+        :param offset: stream offset of the first byte queued
+        :param ends: stream offsets of the ends of messages queued; the one reached is removed
+        :return: (bytes, Type.DATA with Type.PSH if a message ends there)
+        """
+        n = min(size, limit)
+        if ends and ends[0] - offset <= n:
+            return ends.popleft() - offset, Type.DATA | Type.PSH
+        return n, Type.DATA
+
+    def deflate(self, data):
+        """Compress app data into zipq, flushed to be decompressed as it arrives
+
+        Compression is switched off for good when, over the last ZIP_PROBE bytes,
+        it saved less than ZIP_MIN_SAVING of them, or saved bytes more slowly
+        than the window sends them.
+        """
+        cpu = time.thread_time()
+        out = self.zipper.compress(data) + self.zipper.flush(zlib.Z_SYNC_FLUSH)
+        self.zip_cpu += time.thread_time() - cpu
+        self.zipq += out
+        self.zip_in += len(data)
+        self.zip_out += len(out)
+        if self.zip_in < ZIP_PROBE:
+            return
+        saved = self.zip_in - self.zip_out
+        rate = self.srtt and self.cc.window() * self.mss / self.srtt    # bytes/sec sent
+        if saved < self.zip_in * ZIP_MIN_SAVING or rate and saved < rate * self.zip_cpu:
+            logging.info('compression off: %d bytes in %d, %.6f sec CPU',
+                         self.zip_in, self.zip_out, self.zip_cpu)
+            self.compress = 0
+            self.zipper = None
+        self.zip_in = self.zip_out = 0
+        self.zip_cpu = 0.
+
+    def persist(self):
+        """Start probing the receive window closed with nothing in flight,
+        when no ACK is coming to open it
+        """
+        if self.base == self.next_seq and self.rtx_next is None \
+                and not self.timer.running(Ev.TO_Persist):
+            self.timer.start_timer(Ev.TO_Persist)
+
+    def update_rto(self, rtt=None):
+        """Update SRTT/RTTVAR with a new RTT sample, and the RTO from them
+
+        :param rtt: RTT sample(in seconds), or None just to undo the backoff
+        """
+        if rtt is not None:
+            if self.srtt is None:  # first sample
+                self.srtt, self.rttvar = rtt, rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            self.stats.add_rtt(rtt)
+        if self.srtt is not None:
+            self.rto = min(max(self.srtt + 4 * self.rttvar, RTO_MIN), RTO_MAX)
+            self.timer.set_intv(Ev.TO_Retransmit, self.rto)
+
+    def retransmit(self):
+        """Retransmit all the packets in the send buffer on timeout,
+        as many as the effective window allows, the rest as ACKs arrive
+        """
+        if self.retries == MAX_RETRIES:     # the peer is gone
+            logging.warning('no ACK after %d retransmissions: closed', self.retries)
+            self.failed = True
+            self.state = State.Closed
+            for event in (Ev.TO_Flush, Ev.TO_Persist):
+                self.timer.stop_timer(event)
+            return
+        self.retries += 1
+        # exponential backoff, and Karn's algorithm: no RTT samples from retransmitted packets
+        self.stats.timeouts += 1
+        self.rto = min(self.rto * 2, RTO_MAX)
+        self.timer.set_intv(Ev.TO_Retransmit, self.rto)
+        self.sent_time.clear()
+        self.rtx_time = self.clock()
+        self.cc.on_timeout(int(self.next_seq - self.base), self.rtx_time)
+        self.dupacks = 0
+        self.recover = None
+        self.timer.start_timer(Ev.TO_Retransmit)
+        self.rtx_next = self.base
+        self.go_back()
+
+    def go_back(self):
+        """Retransmit from rtx_next within the effective window"""
+        base, sacked, window = self.base, self.sacked, self.cc.window()
+        while self.rtx_next != self.next_seq and int(self.rtx_next - base) < window:
+            seq = self.rtx_next
+            self.rtx_next += 1
+            sndpkt = self.sndbuf[seq]
+            if self.sack_ok and sacked >> int(seq - base) & 1:  # the receiver has it
+                self.stats.sack_skipped += 1
+                self.stats.sack_saved += len(sndpkt)
+                continue
+            self.udt_send(sndpkt)
+        if self.rtx_next == self.next_seq:
+            self.rtx_next = None
+
+    def fast_retransmit(self):
+        """Retransmit the packet at base, presumed lost"""
+        self.stats.fast_retransmits += 1
+        self.sent_time.pop(self.base, None)     # Karn's algorithm
+        self.udt_send(self.sndbuf[self.base])
+        self.timer.start_timer(Ev.TO_Retransmit)
+
+    def duplicate_ACK(self):
+        """Count duplicate ACKs, retransmitting fast on the third one"""
+        self.dupacks += 1
+        if self.dupacks == 3 and self.recover is None and self.rtx_next is None:
+            self.recover = self.next_seq    # reduce the window once per window of loss
+            self.cc.on_loss(int(self.next_seq - self.base), self.clock())
+            self.fast_retransmit()
+
+    def dequeued(self, n):
+        """Account n bytes taken from the send buffer: how long the oldest waited"""
+        self.stats.app_bytes += n
+        times = self.sndq_times
+        self.stats.queue_wait.add(self.clock() - times[0][1])
+        self.sndq_out += n
+        while times and times[0][0] <= self.sndq_out:
+            times.popleft()
+
+    def send_packet(self, type, data=b'', app=None, sure=None):
+        """Make new packet and send it
+
+        :param type: packet type
+        :param data: payload
+        :param app: app bytes it may deliver, if not the payload(compressed)
+        :param sure: app bytes it surely delivers, if not the payload(compressed)
+        """
+        if self.sack:
+            type |= Type.SACK
+        options = None
+        if type & Type.DATA:
+            if self.fec:
+                type |= Type.PARITY
+            if self.compress and self.zipper is None:   # offer compression
+                options = {Opt.ZIP: bytes([ZIP_ZLIB])}
+            self.stats.wire_bytes += len(data)
+            self.app_sent += len(data) if app is None else app
+            self.app_sure += len(data) if sure is None else sure
+            if self.compress:   # for the window in app bytes
+                self.app_marks.append((self.next_seq, self.app_sure))
+        sndpkt = self.make_pkt(type, self.next_seq, data, options)
+        self.sndbuf[self.next_seq] = sndpkt
+        self.sent_time[self.next_seq] = self.clock()
+        self.udt_send(sndpkt)
+        if self.fec_ok and type & Type.DATA:
+            if self.parity is None:
+                self.parity = Parity(self.next_seq)
+            self.parity.add(sndpkt)
+            self.parity.count += 1
+            if self.parity.count == self.fec:
+                self.send_parity()
+        if self.base == self.next_seq:  # first packet in the window
+            self.timer.start_timer(Ev.TO_Retransmit)
+        self.next_seq += 1
+        self.stats.window.add(int(self.next_seq - self.base))
+
+    def send_parity(self):
+        """Send the parity packet of the current block, and start a new block"""
+        parity, self.parity = self.parity, None
+        self.stats.parity_sent += 1
+        self.udt_send(self.make_pkt(Type.PARITY, parity.seq, parity.payload()))
+
+    def coalesce_ACKs(self, pdus, release=None):
+        """ACK fast path: drop the ACKs changing nothing, parsing only their headers
+
+        Corrupt and stale ACKs are dropped, and so are new ACKs superseded by a higher one
+        in the batch. Duplicate ACKs are counted for fast retransmit and dropped, unless
+        they carry SACK blocks or move the window edge, in segments or in app bytes.
+        Note: the ACKs dropped are not traced.
+
+        :param pdus: raw packets arrived in a batch, in order
+        :param release: callback taking each raw packet dropped, if any
+        :return: raw packets to handle as Ev.Packet_Arrival, the highest new ACK last
+        """
+        stats, bits, mod = self.stats, self.base.BITS, self.base.MOD
+        base = int(self.base)
+        outstanding = int(self.next_seq - self.base)
+        slow, best, best_d = [], None, 0    # the highest new ACK so far
+        for pdu in pdus:
+            if len(pdu) < 4 or ichecksum(pdu):
+                stats.rcvd += 1
+                stats.corrupt += 1
+            else:
+                header = parse_header(pdu)
+                if header is None:      # malformed: left to the slow path
+                    slow.append(pdu)
+                    continue
+                type, seq, width, options = header
+                if not type & Type.ACK or width != bits:
+                    slow.append(pdu)
+                    continue
+                d = (seq - base) % mod
+                if 0 < d <= outstanding:    # new ACK: keep the highest
+                    if best is not None:
+                        stats.rcvd += 1
+                        stats.acks_coalesced += 1
+                        if release:
+                            release(best if d >= best_d else pdu)
+                    if d >= best_d:
+                        best, best_d = pdu, d
+                    continue
+                if d == 0 and best is None and options and (
+                        Opt.SACK in options or Opt.WND in options and (
+                            self.window_edge(self.base, options[Opt.WND]) != self.wnd_edge
+                            or self.app_edge is not None and self.app_edge !=
+                            self.app_acked + int.from_bytes(options[Opt.WND], 'big'))):
+                    slow.append(pdu)
+                    continue
+                stats.rcvd += 1
+                stats.acks_dropped += 1
+                if d == 0 and best is None and outstanding and self.cc.fast_retransmit:
+                    self.duplicate_ACK()
+            if release:
+                release(pdu)
+        if best is not None:
+            slow.append(best)
+        return slow
+
+    def window_edge(self, acknum, wnd):
+        """Seq beyond the receive window advertised with the ACK, in full segments"""
+        return acknum + min(int.from_bytes(wnd, 'big') // self.mss, self.N)
+
+    def handle_ACK(self, packet):
+        """Handle arriving ACK packet
+        """
+        acknum = packet.seq     # next sequence number expected by the receiver
+        if acknum < self.base:  # overtaken by a newer ACK
+            return
+        marks = self.app_marks
+        while marks and marks[0][0] < acknum:
+            self.app_acked = marks.popleft()[1]
+        if packet.type & Type.EXT:
+            wnd = packet.options.get(Opt.WND)
+            if wnd is not None:
+                self.wnd_edge = self.window_edge(acknum, wnd)
+                if self.wnd_edge != acknum:     # open: no more backoff
+                    self.timer.set_intv(Ev.TO_Persist, self.persist_intv)
+                self.app_edge = self.app_acked + int.from_bytes(wnd, 'big')
+        if self.sack and packet.type & Type.SACK:   # the receiver supports them
+            self.sack_ok = True
+        if self.sack_ok:
+            self.handle_SACK(packet, acknum)
+        if self.fec and packet.type & Type.PARITY:
+            self.fec_ok = True
+        if self.compress and self.zipper is None and packet.type & Type.ZIP:
+            self.zipper = zlib.compressobj(self.compress)
+        if not (self.base < acknum <= self.next_seq):
+            # duplicate or stale ACK
+            if acknum == self.base != self.next_seq and self.cc.fast_retransmit:
+                self.duplicate_ACK()
+            return
+        now = self.clock()
+        acked = int(acknum - self.base)
+        self.retries = 0
+        self.sacked >>= acked
+        self.sndbuf.advance_base(acknum)
+        self.base = acknum
+        # RTT sample from the newest packet ACKnowledged, if not retransmitted
+        sent_time, rtt = self.sent_time, None
+        while sent_time:
+            seq = next(iter(sent_time))     # in sequence order
+            if not seq < acknum:
+                break
+            sent = sent_time.pop(seq)
+            if seq == acknum - 1:
+                rtt = now - sent
+        if self.rtx_time is not None:
+            # ACKnowledged too soon to be for the retransmission: the original was not lost
+            if self.stats.rtt_min is not None and now - self.rtx_time < self.stats.rtt_min / 2:
+                self.stats.spurious += 1
+                self.update_rto()   # undo the backoff
+            self.rtx_time = None
+        if rtt is not None:
+            self.update_rto(rtt)
+        self.dupacks = 0
+        self.cc.on_ack(acked, now, self.srtt)
+        if self.recover is not None:
+            if self.base < self.recover:    # partial ACK: the next one is lost too
+                self.fast_retransmit()
+            else:
+                self.recover = None
+        if self.rtx_next is not None:
+            if self.rtx_next < self.base:
+                self.rtx_next = self.base
+            self.go_back()
+        sources_sent = self.sources_sent
+        while sources_sent and not self.base < sources_sent[0][0]:
+            sources_sent.popleft()[1]()     # all ACKnowledged
+        if self.base == self.next_seq:  # all ACKnowledged
+            self.timer.stop_timer(Ev.TO_Retransmit)
+        else:
+            self.timer.start_timer(Ev.TO_Retransmit)
+
+    def handle_SACK(self, packet, acknum):
+        """Mark the packets reported in the SACK blocks of the ACK"""
+        blocks = packet.options.get(Opt.SACK)
+        if not blocks or acknum < self.base:
+            return
+        width = self.base.BITS // 8
+        seq_cls = self.base.__class__
+        for i in range(0, len(blocks) - 2 * width + 1, 2 * width):
+            start = seq_cls(int.from_bytes(blocks[i:i+width], 'big'))
+            end = seq_cls(int.from_bytes(blocks[i+width:i+2*width], 'big'))
+            if not (acknum <= start < end <= self.next_seq):
+                continue    # stale or bogus block
+            if start < self.base:   # clipped to the packets outstanding
+                start = self.base
+            lo, hi = int(start - self.base), int(end - self.base)
+            if lo < hi:
+                self.sacked |= ((1 << (hi - lo)) - 1) << lo
+
+    def _log(self, event='', chunk=''):
+        if self.trace is not None:
+            self.trace.add(self.clock(), self.state, event, self.base, chunk)
+        if not logging.getLogger().isEnabledFor(logging.INFO):
+            return
+        event_name = event.name if event else ''
+        if event == Ev.Packet_Arrival and chunk.corrupt():
+            chunk = '*corrupt*'
+        logging.info('%s %s:%s %s %s', self.state.name, self.base, self.next_seq, event_name, chunk)
+
+    def reset(self):
+        """Reopen the closed entity for the next transfer: buffers, RTO, congestion window
+        and compression are kept, and sequence numbers go on from the FIN
+        """
+        self.state = State.Wait
+        self.timer.stop_timer(Ev.TO_Linger)
+
+    def transition(self, event, chunk=''):
+        self._log(event, chunk)
+        rcvpkt = data = chunk
+
+        if self.state == State.Wait:
+            if event == Ev.App_Request:
+                if isinstance(data, Source):
+                    self.sources.append(data)
+                    self.flush_due = True       # the stream buffer goes first
+                elif data:
+                    self.sndq += data
+                    self.sndq_in += len(data)
+                    self.sndq_times.append((self.sndq_in, self.clock()))
+                    if isinstance(data, Message):
+                        self.msg_ends.append(self.sndq_in)
+                elif data is None:              # flush
+                    self.flush_due = True
+                else:                           # end of data
+                    self.flush_due = self.fin_pending = True
+                self.push()
+            elif event == Ev.TO_Retransmit:
+                self.retransmit()
+            elif event == Ev.TO_Flush:
+                self.flush_due = True
+                self.push()
+            elif event == Ev.TO_Persist:
+                # probe with an empty DATA packet, whose ACK advertises the window,
+                # backing off until the window opens
+                if self.base == self.next_seq and self.rtx_next is None:
+                    self.send_packet(Type.DATA)
+                self.timer.set_intv(Ev.TO_Persist,
+                                    min(self.timer.get_intv(Ev.TO_Persist) * 2, RTO_MAX))
+            elif event == Ev.Packet_Arrival:
+                if not rcvpkt.corrupt() and rcvpkt.type & Type.ACK:
+                    self.handle_ACK(rcvpkt)
+                    self.push()
+                rcvpkt.release()
+            return
+
+        if self.state == State.Closing:     # FIN sent, then waiting for FINACK
+            if event == Ev.TO_Retransmit:  # not yet ACKnowleged for DATA or FIN sent
+                self.retransmit()
+            elif event == Ev.Packet_Arrival:
+                if not rcvpkt.corrupt() and rcvpkt.type & Type.ACK:
+                    self.handle_ACK(rcvpkt)      # remaining ACKs
+                    if self.base == self.next_seq:  # no more packets to retransmit
+                        self.state = State.Closed
+                        self._log()
+                else:
+                    pass        # do nothing if packet corrupted, etc.
+                rcvpkt.release()
+            return
+
+        if self.state == State.Closed:      # lingering
+            if event == Ev.App_Request and data:    # the next transfer
+                self.reset()
+                self.transition(event, data)
+            elif event == Ev.Packet_Arrival:
+                rcvpkt.release()    # late ACKs
+
+
+# GBN Receiving-side FSM
+class RecvFSM(Entity):
+    def __init__(self, N, timer=None, sid=None, seqbits=8, delayed_ack=True, link=None):
+        """GBN receiving-side
+
+        :param N:    receive window size
+        :param sid:  session id, if any
+        :param seqbits: initial sequence number width, following the sender's one
+        :param delayed_ack: ACK every second in-order packet or on TO_DelayedACK,
+                            otherwise every packet
+        :param link: netem.Link emulating the path to the sender
+        """
+
+        Entity.__init__(self, N, timer, sid, seqbits, link)
+        self.rcvbuf = PacketBuffer(self.N, self.base)
+        self.FIN_delivered = False
+        self.start_time = None
+        self.sack = False   # whether the sender asked for selective ACKs
+        self.fec = False    # whether the sender asked for FEC
+        self.parities = {}  # seq -> Parity of the blocks with more than one packet missing
+        self.fec_kept = {}  # seq -> packet delivered, kept to rebuild the rest of its block
+        self.unzip = None   # zlib decompressor, once the sender offered compression
+        self.delayed_ack = delayed_ack
+        self.unacked = 0    # packets arrived, not yet ACKnowledged
+        self.sink = None    # object writing data in place of deliver, if any
+        self.stream = None  # StreamBuffer advertising its free space as the window, if any
+
+    def _log(self, event='', chunk=''):
+        if self.trace is not None:
+            self.trace.add(self.clock(), self.state, event, self.base, chunk)
+        if not logging.getLogger().isEnabledFor(logging.INFO):
+            return
+        event_name = event.name if event else ''
+        if event == Ev.Packet_Arrival and chunk.corrupt():
+            chunk = '*corrupt*'
+        logging.info('%s %s:%s %s %s', self.state.name, self.base, self.base + self.N, event_name, chunk)
+
+    def reset(self):
+        """Reopen the closing entity for the next transfer, from the seq after the FIN"""
+        self.state = State.Wait
+        self.FIN_delivered = False
+        self.timer.stop_timer(Ev.TO_Closing)
+
+    def switch_sink(self, sink):
+        """Write the data from now on into the sink, after the data in the stream buffer.
+        sink.done is set once nothing more is written into it, at the end of data.
+        """
+        if self.stream is not None and self.stream.move_to(sink):  # the data ended already
+            sink.done.set()
+        else:
+            self.sink = sink
+
+    def end_message(self):
+        """Mark the end of a message after the data delivered, as EOM"""
+        if self.sink is None:
+            self.deliver(EOM)
+        elif self.sink is self.stream:
+            self.sink.write(EOM)
+
+    def feedback_ACK(self):
+        """Make an ACK packet then send it
+        """
+        self.stats.acks += 1
+        self.stats.acks_suppressed += max(self.unacked - 1, 0)
+        self.unacked = 0
+        self.timer.stop_timer(Ev.TO_DelayedACK)
+        # cumulative ACK for the next sequence number expected, like TCP
+        options = {}
+        if self.stream is not None:     # receive window
+            options[Opt.WND] = min(self.stream.window(), 0xFFFFFFFF).to_bytes(4, 'big')
+        type = Type.ACK
+        if self.fec:
+            type |= Type.PARITY
+        if self.unzip is not None:
+            type |= Type.ZIP
+        if not self.sack:
+            self.udt_send(self.make_pkt(type, self.base, options=options))
+            return
+        # with SACK blocks of the packets buffered out of order
+        width = self.base.BITS // 8
+        blocks = bytearray()
+        for i, (start, end) in enumerate(self.rcvbuf.runs()):
+            if i == MAX_SACK_BLOCKS:
+                break
+            blocks += int(start).to_bytes(width, 'big') + int(end).to_bytes(width, 'big')
+        if blocks:
+            options[Opt.SACK] = blocks
+        self.udt_send(self.make_pkt(type | Type.SACK, self.base, options=options))
+
+    def handle_packet(self, rcvpkt):
+        """Handle received packet of type DATA or FIN
+
+        Save it into buffer, and scan the rcvbuf.
+        Deliver in-order data to the receiver app.
+        When FIN data(b'') has delivered, mark to notify it to FSM as follow:
+            self.FIN_delivered = True
+        Packets are released once delivered or found to be duplicates;
+        with FEC, the latest delivered are kept for the parities of their blocks.
+        """
+        seq = rcvpkt.seq
+        if seq.__class__ is not self.base.__class__:    # follow the sender's seq width
+            if self.base != 0:
+                rcvpkt.release()
+                return
+            self.base = seq.__class__(0)
+            self.rcvbuf = PacketBuffer(self.N, self.base)
+        if not (self.base <= seq < self.base + self.N) or self.rcvbuf[seq] is not None:
+            rcvpkt.release()    # out of the receive window or duplicate
+            return
+        self.rcvbuf[seq] = rcvpkt
+        # deliver in-order packets
+        while self.rcvbuf.bitmap & 1:   # packet at base
+            packet = self.rcvbuf.popleft()
+            fin = packet.type & Type.FIN
+            data = packet.extract()
+            self.stats.wire_bytes += len(data)
+            if packet.type & Type.ZIP:
+                data = self.unzip.decompress(data)
+            self.stats.app_bytes += len(data)
+            if self.sink is not None and not fin:
+                if data:    # b'' would end the data
+                    self.sink.write(data)
+            elif data or fin:
+                self.deliver(bytes(data))   # copy out of the receive buffer
+            if packet.type & Type.PSH:
+                self.end_message()
+            if self.fec and not fin:
+                self.keep(self.base, packet)
+            else:
+                packet.release()
+            self.base += 1
+            if fin:
+                self.FIN_delivered = True
+                if self.sink is not self.stream:    # a sink ends with the data
+                    self.sink.done.set()
+                    self.sink = self.stream
+                break
+        if self.parities:
+            self.retry_parities(seq)
+
+    def keep(self, seq, packet):
+        """Keep the latest packets delivered, for the parities of their blocks"""
+        kept = self.fec_kept
+        kept[seq] = packet
+        if len(kept) > FEC_MAX_BLOCK:
+            kept.pop(next(iter(kept))).release()    # the oldest
+
+    def handle_parity(self, rcvpkt):
+        """Handle received parity packet
+
+        :return: whether a lost packet was rebuilt from it
+        """
+        seq, payload = rcvpkt.seq, rcvpkt.payload
+        parity = None
+        if seq.__class__ is self.base.__class__ and len(payload) >= 4 and payload[0]:
+            parity = Parity(seq, payload)
+        rcvpkt.release()
+        return parity is not None and self.recover(parity)
+
+    def recover(self, parity):
+        """Rebuild the one packet missing in the block of the parity, and handle it.
+        With more missing, the parity waits for them in self.parities.
+
+        :return: whether a packet was rebuilt
+        """
+        base, kept = self.base, self.fec_kept
+        missing, found = [], []
+        for seq in srange(parity.seq, parity.seq + parity.count):
+            if seq < base:
+                packet = kept.get(seq)
+                if packet is None:  # delivered long ago, or before FEC
+                    return False
+            elif seq < base + self.N:
+                packet = self.rcvbuf[seq]
+            else:
+                return False    # beyond the receive window
+            if packet is None:
+                missing.append(seq)
+            else:
+                found.append(packet)
+        if len(missing) != 1:
+            if missing and len(self.parities) < self.N:
+                self.parities[parity.seq] = parity
+            return False
+        for packet in found:
+            parity.add(packet)
+        rcvpkt = parity.rebuild(missing[0])
+        if not rcvpkt.type & Type.DATA:     # bogus parity
+            return False
+        self.stats.fec_recovered += 1
+        self.handle_packet(rcvpkt)
+        return True
+
+    def retry_parities(self, seq):
+        """Retry the parities waiting for the block of the packet arrived,
+        dropping the ones of the blocks delivered
+        """
+        parities = self.parities
+        for start in list(parities):
+            parity = parities.get(start)    # may be gone in the recovery of another one
+            if parity is None:
+                continue
+            if not self.base < start + parity.count:
+                del parities[start]
+            elif int(seq - start) < parity.count:
+                del parities[start]
+                self.recover(parity)
+
+    def transition(self, event, chunk=''):
+        self._log(event, chunk)
+        rcvpkt = chunk
+        if self.start_time is None:
+            self.start_time = self.clock()
+
+        # state transition
+        if self.state == State.Wait:
+            if event == Ev.Packet_Arrival:
+                if rcvpkt.corrupt() or not rcvpkt.type & (Type.DATA | Type.FIN | Type.PARITY):
+                    rcvpkt.release()
+                    return
+                if rcvpkt.type & (Type.DATA | Type.FIN):
+                    if rcvpkt.type & Type.SACK:
+                        self.sack = True
+                    if rcvpkt.type & Type.PARITY:
+                        self.fec = True
+                    if self.unzip is None and rcvpkt.type & Type.EXT \
+                            and rcvpkt.options.get(Opt.ZIP) == bytes([ZIP_ZLIB]):
+                        self.unzip = zlib.decompressobj()
+                    # in order with no hole behind, not filling a hole
+                    in_order = rcvpkt.seq == self.base and not self.rcvbuf.bitmap
+                    self.handle_packet(rcvpkt)
+                elif self.handle_parity(rcvpkt):    # a lost packet rebuilt, filling a hole
+                    in_order = False
+                else:
+                    return
+                self.unacked += 1
+                if not self.delayed_ack or not in_order or self.FIN_delivered \
+                        or self.unacked >= 2:
+                    self.feedback_ACK()
+                else:
+                    self.timer.start_timer(Ev.TO_DelayedACK)
+                if self.FIN_delivered:
+                    self.state = State.Closing
+                    self.timer.start_timer(Ev.TO_Closing)
+            elif event == Ev.TO_DelayedACK:
+                if self.unacked:
+                    self.feedback_ACK()
+            elif event == Ev.App_Request:
+                if chunk is None:       # window update
+                    self.feedback_ACK()
+                else:                   # data to the sink from now on
+                    self.switch_sink(chunk)
+            return
+
+        # Whenever GBNsend do not receive the final ACK,
+        # duplicated FIN might be coming.
+        if self.state == State.Closing:
+            if event == Ev.TO_Closing:         # termination timer timeout
+                self.state = State.Closed
+                self.stats.elapsed = self.clock() - self.start_time
+                self._log()
+            elif event == Ev.Packet_Arrival:
+                if not rcvpkt.corrupt() and rcvpkt.type & (Type.DATA | Type.FIN) \
+                        and rcvpkt.seq.__class__ is self.base.__class__ \
+                        and self.base <= rcvpkt.seq < self.base + self.N:    # the next transfer
+                    self.reset()
+                    self.transition(event, rcvpkt)
+                    return
+                if not rcvpkt.corrupt():    # the sender is still there
+                    self.timer.start_timer(Ev.TO_Closing)
+                self.feedback_ACK()  # retransmit
+                rcvpkt.release()
+            elif event == Ev.App_Request and chunk is not None:   # before the next transfer
+                self.switch_sink(chunk)
+
+
+# Receiving app API over the StreamBuffer self.stream, shared by the receiving entities
+class StreamReceiver:
+    # API - called by receiving applications
+    def recv(self, max_bytes=None, timeout=None):
+        """Request to receive data: the in-order bytes ready, as a stream
+
+        :param max_bytes: max bytes to return, all the data ready if None
+        :param timeout: seconds to wait, forever if None
+        :return: data (bytes type), b'' at the end of data
+        :raise queue.Empty: if timed out
+        """
+        return self.stream.read(max_bytes, timeout)
+
+    def recv_into(self, buffer, timeout=None):
+        """Request to receive data into a writable bytes-like buffer
+
+        :param timeout: seconds to wait, forever if None
+        :return: number of bytes received, 0 at the end of data
+        :raise queue.Empty: if timed out
+        """
+        return self.stream.readinto(buffer, timeout)
+
+    def readexactly(self, n, timeout=None):
+        """Request to receive exactly n bytes
+
+        :param timeout: seconds to wait, forever if None
+        :raise EOFError: if the data end first
+        :raise queue.Empty: if timed out
+        """
+        return self.stream.readexactly(n, timeout)
+
+    def recv_many(self, max_bytes=None, timeout=None):
+        """Request to receive the data ready, as a list of chunks
+
+        :param max_bytes: max bytes to return, all the data ready if None
+        :param timeout: seconds to wait, forever if None
+        :return: list of data chunks, ending with b'' at the end of data
+        :raise queue.Empty: if timed out
+        """
+        chunks = [self.recv(max_bytes, timeout)]
+        if chunks[0] and self.stream.eof:
+            chunks.append(self.recv(0))     # b'', consumed
+        return chunks
+
+    def recv_message(self, timeout=None):
+        """Request to receive the next message whole
+
+        :param timeout: seconds to wait, forever if None
+        :return: data (bytes type), b'' at the end of data
+        :raise queue.Empty: if timed out
+        """
+        return self.stream.read_message(timeout)
+
+
+# GBN abstract super class running in a thread
+class GBN(threading.Thread, StreamReceiver):
+    def __init__(self, peer, port=None, queue_bytes=None):
+        """
+        :param peer: peer (hostname, port)
+        :param port: local port, default by the peer port; 0 for an ephemeral port
+        :param queue_bytes: bytes down_queue holds, unbounded if None
         """
 
         threading.Thread.__init__(self, name=self.__class__.__name__)
@@ -124,112 +1674,292 @@ class GBN(threading.Thread):
         # connected UDP socket. Actually, no 3-way handshake like TCP
         # just for omitting `to` field and for easy handing socket error
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        if peer[1] == sender_port:
+        if port is not None:
+            self.sock.bind(('', port))
+        elif peer[1] == sender_port:
             self.sock.bind(('', receiver_port)) # receiver socket addr
         else:
             self.sock.bind(('', sender_port))   # sender socket addr
         self.sock.connect(peer)     # just for remembering peer address
 
-        self.down_queue = queue.Queue(1)    # interface from app to GBN
-        self.up_queue = queue.Queue(1)      # interface from GBN to app
-        self.stats = Statistics()
-        self.timer = Timer()
+        # the FSM thread blocks on the socket and on a wakeup socket
+        # which the app threads poke whenever down_queue becomes non-empty
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ)
+
+        self.down_queue = ByteQueue(queue_bytes, self.wakeup)  # interface from app to GBN
+        self.stream = None  # interface from GBN to app: StreamBuffer of the receiving side
+        self.closed = threading.Event()     # set when the FSM reaches Closed
+        self.pool = BufferPool(RCV_BUFSIZE)     # receive buffers
+        self.delayed = []   # min-heap of (time to send, order, buffers) for delay emulation
+        self._order = itertools.count()
 
     # lower layer(UDT) interface complying with the textbook
-    def udt_send(self, packet: Packet):
-        """Unreliable data transfer via connected UDP socket
-        to simulate noisy, lossy, and random delayed network environment
-        """
-        # enforce loss
-        self.stats.sent += 1
-        if LOSSRATE > 0 and random.random() <= LOSSRATE:
-            self.stats.dropping += 1
-            logging.info(f'udt_send: [dropping] {packet}')
-            return
-        # enforce delay
-        if EXTRA_MEAN_DELAY > 0:
-            # send after exponential distributed delay
-            time.sleep(random.expovariate(1.0 / EXTRA_MEAN_DELAY))
-        # enforce bit error
-        if PER >0 and random.random() < PER:
-            pdu = copy.copy(packet.pdu)  # deep copy for emulating bit errors
-            i = random.randrange(len(pdu))
-            pdu[i] = pdu[i] ^ 1  # XOR, enforce bit error
-            self.sock.send(pdu)
-            self.stats.corrupting += 1
-            logging.info(f'udt_send: [corrupting] {Packet(pdu)}')
+    def transmit(self, buffers, delay=0.):
+        """Send via connected UDP socket, or after the delay without blocking the FSM"""
+        if delay > 0:
+            heapq.heappush(self.delayed, (time.monotonic() + delay, next(self._order), buffers))
         else:
-            self.sock.send(packet.pdu)
-            logging.debug(f'udt_send: {packet}')
+            self._sendmsg(buffers)
+
+    def _sendmsg(self, buffers):
+        try:
+            sendmsg(self.sock, buffers)
+        except ConnectionRefusedError:  # reported for an earlier packet: this one is lost
+            logging.info(f'{self.__class__.__name__}: connection refused')
+
+    def send_delayed(self):
+        """Send the delayed packets due
+
+        :return: time to send the next one, None if none left
+        """
+        delayed = self.delayed
+        now = time.monotonic()
+        while delayed and delayed[0][0] <= now:
+            self._sendmsg(heapq.heappop(delayed)[2])
+        return delayed[0][0] if delayed else None
 
     def rdt_rcv(self):
         """Unreliable data reception via connected UDP socket
         """
-        pdu = self.sock.recv(2048)  # remove the packet
-        packet = Packet(pdu)
+        packet = self.pool.recv(self.sock)  # remove the packet
         # logging.debug(f'rdt_rcv:  {packet}')
-        self.stats.rcvd += 1
-        if packet.corrupt():
-            self.stats.corrupt += 1
-        return packet
+        return self.received(packet)
+
+    def rdt_rcv_all(self, count=MAX_BATCH):
+        """Unreliable data reception of the packets queued in the socket, up to count
+
+        One select wakeup serves a burst of packets. Without MSG_DONTWAIT(Windows),
+        only one packet is received.
+
+        :return: list of packets, empty if only an ICMP error has arrived
+        """
+        return [self.received(self.pool.packet(pdu)) for pdu in self.rdt_rcv_pdus(count)]
+
+    def rdt_rcv_pdus(self, count=MAX_BATCH):
+        """Like rdt_rcv_all, but the raw packets viewing pooled buffers, not counted yet
+
+        :return: list of memoryviews; make them packets by self.pool.packet(),
+                 or return the buffers by self.release_pdu()
+        """
+        pdus = []
+        try:
+            pdus.append(self.pool.recv_pdu(self.sock))
+            while _DONTWAIT and len(pdus) < count:
+                pdus.append(self.pool.recv_pdu(self.sock, _DONTWAIT))
+        except BlockingIOError:
+            pass
+        except ConnectionRefusedError:  # port unreachable: the peer is gone, or not yet there
+            logging.info(f'{self.__class__.__name__}: connection refused')
+        return pdus
+
+    def release_pdu(self, pdu):
+        """Return the buffer of a raw packet from rdt_rcv_pdus"""
+        self.pool.put(pdu.obj)
 
     # API - called by sending applications
-    def send(self, data):
-        """Request to send data
+    def send(self, data, timeout=None):
+        """Request to send data, waiting while down_queue is full
+
+        Data are a byte stream: split into packets of up to mss bytes,
+        and small ones are merged until flush or TO_Flush.
+
+        :param timeout: seconds to wait, forever if None
+        :raise queue.Full: if timed out
+        :raise ConnectionError: if the entity has ended, after lingering
         """
         if not isinstance(data, (bytes, bytearray)):
             raise TypeError('Data should be bytes or bytearray type')
         if data:
-            self.down_queue.put(data)
-            logging.debug(f'send: {data}')
+            if isinstance(data, bytearray):
+                data = bytes(data)  # the FSM thread reads it later
+            self.down_queue.put(data, timeout)
+            logging.debug('send: %s', data)
 
-    def close(self):
-        """Request to close the session
+    def send_message(self, data, timeout=None):
+        """Request to send data as one message, going out without waiting for a full packet
+
+        The receiving app gets it whole by recv_message().
+
+        :param timeout: seconds to wait, forever if None
+        :raise queue.Full: if timed out
+        :raise ConnectionError: if the entity has ended, after lingering
         """
-        self.down_queue.put(b'')    # empty byte denotes end of data
-        while True:
-            if self.down_queue.empty():
-                logging.info('app terminates')
-                return
-            time.sleep(0.001)
+        if not isinstance(data, (bytes, bytearray)):
+            raise TypeError('Data should be bytes or bytearray type')
+        if not data:
+            raise ValueError('empty message')
+        self.down_queue.put(Message(data), timeout)
+
+    def send_many(self, chunks, timeout=None):
+        """Request to send the chunks, handed over to the FSM thread in one go
+
+        :param chunks: iterable of bytes or bytearray
+        :param timeout: seconds to wait in total, forever if None
+        :raise queue.Full: if timed out; the chunks before have been queued
+        """
+        chunks = [bytes(c) if isinstance(c, bytearray) else c for c in chunks if c]
+        if not all(isinstance(c, bytes) for c in chunks):
+            raise TypeError('Data should be bytes or bytearray type')
+        self.down_queue.put_many(chunks, timeout)
 
-    # API - called bu receiving applications
-    def recv(self):
-        """Request to receive data
+    def sendall(self, data):
+        """Request to send bytes-like data, in pieces of up to the send buffer size
+        """
+        view = memoryview(data).cast('B')
+        step = self.sndq_limit
+        for i in range(0, len(view), step):
+            self.send(bytes(view[i:i+step]))
+
+    def flush(self):
+        """Request to send the data buffered without waiting for a full packet
+        """
+        self.down_queue.put(None)
 
-        :return: data (bytes or bytearray type)
+    def sendfile(self, file, progress=None):
+        """Send a file through mmap, slicing the mapped regions into packets without copying
+
+        A few regions of about the send buffer size are mapped at a time.
+
+        :param file: path, or binary file object to send from its current position
+        :param progress: callback taking (bytes ACKnowledged, total bytes), per region
+        :return: number of bytes sent
+        """
+        opened = isinstance(file, (str, bytes, os.PathLike))
+        f = io.open(file, 'rb') if opened else file
+        try:
+            fd = f.fileno()
+            start = f.tell()
+            end = os.fstat(fd).st_size
+            region = map_region(self.sndq_limit)
+            offset = start - start % mmap.ALLOCATIONGRANULARITY
+            pending = deque()   # (mmap, ACKnowledged event, end offset)
+            while offset < end or pending:
+                if offset < end and len(pending) < 3:
+                    length = min(region, end - offset)
+                    mm = mmap.mmap(fd, length, offset=offset, access=mmap.ACCESS_READ)
+                    acked = threading.Event()
+                    self.down_queue.put(Source(memoryview(mm)[max(start - offset, 0):], acked.set))
+                    offset += length
+                    pending.append((mm, acked, offset))
+                    continue
+                mm, acked, sent = pending.popleft()
+                while not acked.wait(0.5):
+                    if self.failed:
+                        raise ConnectionError('the peer stopped answering')
+                try:
+                    mm.close()
+                except BufferError:     # still referred by a packet, unmapped when collected
+                    pass
+                if progress:
+                    progress(sent - start, end - start)
+            if not opened:
+                f.seek(max(start, end))
+            return max(end - start, 0)
+        finally:
+            if opened:
+                f.close()
+
+    def close(self, timeout=None):
+        """Request to close the session, waiting until all data are ACKnowledged
+
+        The entity lingers after closing: sending again within it starts
+        the next transfer over the entity.
+
+        :param timeout: seconds to wait, forever if None
+        :return: True if closed, False if timed out
+        """
+        self.closed.clear()
+        try:
+            self.down_queue.put(b'')    # empty byte denotes end of data
+        except ConnectionError:     # ended after lingering
+            pass
+        if self.ident is not None and not self.is_alive():  # ended, closed already
+            self.closed.set()
+        if not self.closed.wait(timeout):
+            return False
+        logging.info('app terminates')
+        return True
+
+    def recv_into_file(self, path, progress=None):
+        """Receive all the data into a file written through mmap, until the end of data
+
+        :param path: file path, created or truncated
+        :param progress: callback taking bytes written so far, called in the protocol thread
+        :return: number of bytes received
         """
-        return self.up_queue.get()
+        sink = FileSink(path, map_region(self.N * MSS), progress)
+        try:
+            self.down_queue.put(sink)   # the FSM thread switches to the sink
+        except ConnectionError:     # ended: no FSM thread any more
+            self.join()
+            self.switch_sink(sink)
+            sink.done.set()
+        sink.done.wait()    # until the FSM stops writing into it
+        self.recv()     # b'' at the end of data
+        size = sink.size
+        sink.close()
+        return size
 
     # Methods implementing the functions defined in the textbook
     # used in this protocol
     def deliver(self, data):
-        self.up_queue.put(data)
-        logging.debug(f'deliver: {data}')
+        self.stream.write(data)
+        logging.debug('deliver: %s', data)
 
     # Wrapper methods
-    def check_event(self, down_queue=None):
-        # Check packet arrival
-        readable, writable, exceptional = select.select([self.sock], [], [self.sock], 0.)
-        if self.sock in exceptional:
-            raise OSError('socket error')
-        if self.sock in readable:  # something arrives?
-            return Ev.Packet_Arrival
-        # Check timeout
-        event = self.timer.check_timeout()
-        if event:
-            return event
-        # Check data arrival from the application
-        if down_queue is None:
-            return None
-        if down_queue.empty():
-            return None
-        else:
-            return Ev.App_Request
-
-    # delegate implementation to subclasses for providing same interface
-    def _log(self, event='', chunk=''):
-        raise NotImplementedError
+    def wakeup(self):
+        """Wake up the FSM thread blocked in check_event"""
+        try:
+            self._wakeup_w.send(b'\0')
+        except BlockingIOError:
+            pass    # wakeup socket already full, FSM thread is going to wake up anyway
+        except OSError:
+            pass    # closed: the FSM thread has ended
+
+    def check_event(self, down_queue=None, block=False):
+        """Check events in priority order: packet arrival, timeout, app request
+
+        :param down_queue: queue to check app requests, None if not interested
+        :param block: if True, wait until any event occurs
+        :return: event if any, None otherwise (only when block is False)
+        """
+        timeout = 0.
+        while True:
+            delayed = self.send_delayed()
+            arrival = False
+            for key, mask in self.selector.select(timeout):
+                if key.fileobj is self.sock:    # something arrives?
+                    arrival = True
+                else:
+                    self._drain_wakeup()
+            if arrival:
+                return Ev.Packet_Arrival
+            # Check timeout
+            event = self.timer.check_timeout()
+            if event:
+                return event
+            # Check data arrival from the application
+            if down_queue is not None and not down_queue.empty():
+                return Ev.App_Request
+            if not block:
+                return None
+            # sleep until the nearest timer deadline or delayed packet, or until woken up
+            deadline = self.timer.next_deadline()
+            if delayed is not None and (deadline is None or delayed < deadline):
+                deadline = delayed
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0.)
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(512):
+                pass
+        except BlockingIOError:
+            pass
 
     def get_event(self):
         raise NotImplementedError
@@ -242,200 +1972,391 @@ class GBN(threading.Thread):
         logging.info(f'{self.__class__.__name__} starts')
         try:
             self.fsm()
+            while self.send_delayed() is not None:  # packets still in the emulated link
+                time.sleep(max(self.delayed[0][0] - time.monotonic(), 0.))
         except:
             import sys
             logging.exception(sys.exc_info()[:2])
         else:
-            logging.info(f'{self.__class__.__name__} terminates')
-            print('*** GBN parameters ***')
-            print('Window size:', self.N)
-            print('LOSSRATE:', LOSSRATE, 'PER:', PER, 'extra MEAN_DELAY:', EXTRA_MEAN_DELAY)
-            print('\n*** Statistics ***')
-            print(self.stats)
-            print("hong.gbn")
+            logging.info('%s terminates: N=%d %s\n%s', self.__class__.__name__, self.N, self.link,
+                         self.stats)
+        finally:
+            if self.stream is not None:
+                self.stream.finish()
+            self.selector.close()
+            for sock in (self.sock, self._wakeup_r, self._wakeup_w):
+                sock.close()
+            self.closed.set()
 
 
 # GBN Sending-side Protocol Entity
-class GBNsend(GBN):
-    def __init__(self, peer, N):
+class GBNsend(GBN, SendFSM):
+    def __init__(self, peer, N, sid=None, seqbits=8, sack=False, cc=None, mss=MSS, link=None,
+                 queue_bytes=None, port=None, fec=0, compress=0, linger=None):
         """GBN sending-side
 
         :param peer: peer (hostname, port)
         :param N:    send window size
+        :param sid:  session id to a GBNListener, if any
+        :param seqbits: sequence number width: 8, 16 or 32
+        :param sack: ask for selective ACKs
+        :param cc: congestion control policy: 'reno', 'cubic', ..., fixed window if None
+        :param mss: max payload bytes in a DATA packet
+        :param link: netem.Link emulating the path to the receiver
+        :param queue_bytes: bytes the app queues hold, N * mss by default
+        :param port: local port; sender_port, or an ephemeral one with sid, if None
+        :param fec: DATA packets per parity packet, 0 for no FEC
+        :param compress: zlib level compressing the data, 0 for none
+        :param linger: seconds to stay after closing, for the late ACKs and for
+                       the next transfer; LINGER if None
         """
 
-        GBN.__init__(self, peer)
-        self.N = N     # buffer size
-        self.sndbuf = PacketBuffer(self.N)
-        self.state = State.Wait
-        self.base = Seq(0)
-        self.next_seq = Seq(0)
+        if port is None and sid is not None:
+            port = 0
+        GBN.__init__(self, peer, port, queue_bytes or N * mss)
+        SendFSM.__init__(self, N, sid=sid, seqbits=seqbits, sack=sack, cc=cc, mss=mss, link=link,
+                         fec=fec, compress=compress)
+        size_buffers(self.sock, 2 * N * self.pool.size)
+        if linger is not None:
+            self.timer.set_intv(Ev.TO_Linger, linger)
 
-    # Wrapper methods used in FSM
-    def retransmit(self):
-        """Retransmit all the packets in the send buffer"""
+    def get_event(self):
+        # if send buffer is full, postpone Ev.App_Request
+        if self.buffer_open():
+            return self.check_event(self.down_queue, block=True)
+        return self.check_event(block=True)
 
-        ### Your code here
-        pass
+    # GBN sending-side FSM
+    def fsm(self):
+        while True:
+            event = self.get_event()
+            if event == Ev.Packet_Arrival:  # ACKs changing something
+                for pdu in self.coalesce_ACKs(self.rdt_rcv_pdus(), self.release_pdu):
+                    self.transition(event, self.received(self.pool.packet(pdu)))
+            elif event == Ev.TO_Linger:     # no next transfer came
+                if self.down_queue.shutdown():
+                    break
+                self.timer.start_timer(Ev.TO_Linger)    # requests to handle first
+            elif event >= Ev.TO_Retransmit: # all timeout events
+                self.transition(event)
+            elif event == Ev.App_Request:   # as much as the send buffer takes
+                for data in self.down_queue.get_many(self.sndq_limit - len(self.sndq)):
+                    self.transition(event, data)
+                if self.state == State.Closed:  # close() again, with nothing sent
+                    self.closed.set()
+            else:
+                logging.error('Unknown event: %d' % event)
+            if self.failed:     # no lingering for a peer gone
+                self.down_queue.shutdown(discard=True)
+                break
+            if self.state == State.Closed and not self.timer.running(Ev.TO_Linger):
+                # just closed: linger for the late ACKs, and for the next transfer
+                if self.down_queue.empty():     # not with the next one already requested
+                    self.closed.set()
+                self.timer.start_timer(Ev.TO_Linger)
+        # end of while loop
 
-    def send_packet(self, type, data=b''):
-        """Make new packet and send it
+    def close(self, timeout=None):
+        """Request to close the session, waiting until all data are ACKnowledged
 
-        :param type: packet type
-        :param data: payload
+        :param timeout: seconds to wait, forever if None
+        :return: True if closed, False if timed out
+        :raise ConnectionError: if the peer stopped answering, the data left unsent
         """
+        closed = GBN.close(self, timeout)
+        if self.failed:
+            raise ConnectionError('the peer stopped answering')
+        return closed
 
-        ### Your code here
-        pass
 
-    def handle_ACK(self, packet):
-        """Handle arriving ACK packet
+# GBN Receiving-side Protocol Entity
+class GBNrecv(GBN, RecvFSM):
+    def __init__(self, peer, N, seqbits=8, delayed_ack=True, link=None, queue_bytes=None,
+                 port=None, linger=None):
+        """GBN receiving-side
+
+        :param peer: peer (hostname, port)
+        :param N:    receive window size
+        :param seqbits: sequence number width: 8, 16 or 32
+        :param delayed_ack: ACK every second packet or on TO_DelayedACK
+        :param link: netem.Link emulating the path to the sender
+        :param queue_bytes: bytes the receive buffer holds before the window closes,
+                            N * MSS by default
+        :param port: local port, receiver_port if None
+        :param linger: seconds the sender lingers after closing, LINGER if None; the receiver
+                       stays LINGER_MARGIN longer, for duplicate FINs and the next transfer
         """
 
-        ### Your code here
-        pass
+        GBN.__init__(self, peer, port)
+        RecvFSM.__init__(self, N, seqbits=seqbits, delayed_ack=delayed_ack, link=link)
+        size_buffers(self.sock, 2 * N * self.pool.size)
+        if linger is not None:
+            self.timer.set_intv(Ev.TO_Closing, linger + LINGER_MARGIN)
+        # in-order data are written straight into the stream buffer
+        self.stream = self.sink = StreamBuffer(queue_bytes or N * MSS, self.window_update)
 
-    def get_event(self):
-        while True:
-            event = self.check_event(self.down_queue)
-            # if send buffer is full, postpone Ev.App_Request
-            if event == Ev.App_Request and not (self.next_seq < (self.base + self.N)):
-                event = None
-            if event:
-                return event
-            time.sleep(0.01)
+    def window_update(self):
+        """Have the FSM thread advertise the window opened by the app"""
+        try:
+            self.down_queue.put(None)
+        except ConnectionError:     # ended
+            pass
 
-    def _log(self, event='', chunk=''):
-        event_name = event.name if event else ''
-        if event == Ev.Packet_Arrival and chunk.corrupt():
-            chunk = '*corrupt*'
-        logging.info(f'{self.state.name} {self.base}:{self.next_seq} {event_name} {chunk}')
+    def run(self):
+        GBN.run(self)
+        # ended: the sinks requested get the data left, and nothing more
+        for sink in self.down_queue.close():
+            if sink is not None:
+                self.switch_sink(sink)
+        if self.sink is not self.stream:
+            self.sink.done.set()
+
+    def get_event(self):
+        return self.check_event(self.down_queue, block=True)
 
-    # GBN sending-side FSM
     def fsm(self):
         while self.state != State.Closed:
             event = self.get_event()
             if event == Ev.Packet_Arrival:
-                rcvpkt = self.rdt_rcv()
-                self._log(event, rcvpkt)
-            elif event == Ev.TO_Retransmit:
-                self._log(event)
+                for rcvpkt in self.rdt_rcv_all():
+                    self.transition(event, rcvpkt)
+            elif event >= Ev.TO_Retransmit: # all timeout events
+                self.transition(event)
             elif event == Ev.App_Request:
-                data = self.down_queue.get()
-                self._log(event, data)
+                self.transition(event, self.down_queue.get())
             else:
-                self.error('Unknown event: %d' % event)
-                continue
-
-            # state transition
-            if self.state == State.Wait:
-                ### Your code here
-                pass
-
-                continue
-
-            if self.state == State.Closing:     # FIN sent, then waiting for FINACK
-                if event == Ev.TO_Retransmit:  # not yet ACKnowleged for DATA or FIN sent
-                    self.retransmit()
-                elif event == Ev.Packet_Arrival:
-                    if not rcvpkt.corrupt() and rcvpkt.type & Type.ACK:
-                        self.handle_ACK(rcvpkt)      # remaining ACKs
-                        if self.base == self.next_seq:  # no more packets to retransmit
-                            self.state = State.Closed
-                    else:
-                        pass        # do nothing if packet corrupted, etc.
-                continue
+                logging.error('Unknown event: %d' % event)
         # end of while loop
 
-        # Closed state
-        self._log()
-        time.sleep(2)  # to avoid ConnectionResetError in Windows
 
+# GBN receiving-side session served by GBNListener
+class Session(RecvFSM, StreamReceiver):
+    def __init__(self, listener, peer, sid, N, seqbits=8, delayed_ack=True, link=None,
+                 queue_bytes=None):
+        """
+        :param listener: GBNListener owning the socket
+        :param peer: peer (host, port) address
+        :param sid: session id, None for peers not sending it
+        :param N: receive window size
+        :param seqbits: sequence number width
+        :param delayed_ack: ACK every second packet or on TO_DelayedACK
+        :param link: netem.Link emulating the path to the peer
+        :param queue_bytes: bytes the receive buffer holds before the window closes,
+                            N * MSS by default
+        """
+        RecvFSM.__init__(self, N, sid=sid, seqbits=seqbits, delayed_ack=delayed_ack, link=link)
+        self.listener = listener
+        self.peer = peer
+        # in-order data are written straight into the stream buffer
+        self.stream = self.sink = StreamBuffer(queue_bytes or N * MSS, self.window_update)
 
-# GBN Receiving-side Protocol Entity
-class GBNrecv(GBN):
-    def __init__(self, peer, N):
-        """GBN receiving-side
+    def transmit(self, buffers, delay=0.):
+        self.listener.transmit(buffers, self.peer, delay)
 
-        :param peer: peer (hostname, port)
-        :param N:    receive window size
-        """
+    def deliver(self, data):
+        self.stream.write(data)
+        logging.debug('deliver: %s', data)
 
-        GBN.__init__(self, peer)
-        self.N = N     # buffer size
-        self.rcvbuf = PacketBuffer(self.N)
-        self.state = State.Wait
-        self.base = Seq(0)
-        self.FIN_delivered = False
+    def window_update(self):
+        """Have the listener thread advertise the window opened by the app"""
+        self.listener.window_update(self)
 
-    def get_event(self):
-        while True:
-            event = self.check_event()
-            if event:
-                return event
-            time.sleep(0.01)
 
-    def _log(self, event='', chunk=''):
-        event_name = event.name if event else ''
-        if event == Ev.Packet_Arrival and chunk.corrupt():
-            chunk = '*corrupt*'
-        logging.info(f'{self.state.name} {self.base}:{self.base+self.N} {event_name} {chunk}')
+# GBN receiving-side entity demultiplexing many sessions on one socket
+class GBNListener(threading.Thread):
+    def __init__(self, addr, N, seqbits=8, delayed_ack=True, link=None, linger=None,
+                 queue_bytes=None):
+        """
+        :param addr: local (host, port) address to listen on
+        :param N: receive window size of each session
+        :param seqbits: sequence number width of the sessions
+        :param delayed_ack: whether the sessions delay ACKs
+        :param link: netem.Link shared by the sessions, by the module parameters if None
+        :param linger: seconds the senders linger after closing, LINGER if None;
+                       closing sessions are kept LINGER_MARGIN longer, for their next transfer
+        :param queue_bytes: bytes the receive buffer of each session holds
+                            before its window closes, N * MSS by default
+        """
 
-    def feedback_ACK(self):
-        """Make an ACK packet then send it
+        threading.Thread.__init__(self, name=self.__class__.__name__, daemon=True)
+        self.N = N
+        self.seqbits = seqbits
+        self.delayed_ack = delayed_ack
+        self.link = link
+        self.linger = linger
+        self.queue_bytes = queue_bytes
+        self.updates = deque()  # sessions whose app opened the window, from the app threads
+        self.delayed = []   # min-heap of (time to send, order, buffers, address)
+        self._order = itertools.count()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(addr)
+        self.sessions = {}      # (peer address, session id) -> Session
+        self.accept_queue = queue.Queue()
+        self.stats = Statistics()   # packets not belonging to any session
+        self.pool = BufferPool(RCV_BUFSIZE)     # receive buffers shared by the sessions
+        size_buffers(self.sock, 8 * N * self.pool.size)
+        self.closing = False
+
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ)
+
+    # API - called by receiving applications
+    def accept(self, timeout=None):
+        """Wait for a new session
+
+        :param timeout: seconds to wait, forever if None
+        :return: Session object, whose recv() returns the session's data
+        :raise queue.Empty: if timed out
         """
+        return self.accept_queue.get(timeout=timeout)
 
-        ### Your code here
-        pass
+    def close(self):
+        """Stop listening; sessions not yet closed are abandoned"""
+        self.closing = True
+        self.wakeup()
+        self.join()
 
-    def handle_packet(self, rcvpkt):
-        """Handle received packet of type DATA or FIN
+    def wakeup(self):
+        """Wake up the listener thread blocked in select"""
+        try:
+            self._wakeup_w.send(b'\0')
+        except BlockingIOError:
+            pass    # wakeup socket already full, the listener thread is going to wake up anyway
+        except OSError:
+            pass    # closed: the listener has ended
+
+    def dispatch(self, packet, addr):
+        """Hand a received packet to its session, creating a new session if needed"""
+        if packet.corrupt():       # session id cannot be trusted
+            self.stats.rcvd += 1
+            self.stats.corrupt += 1
+            packet.release()
+            return
+        sid = packet.options.get(Opt.SID)
+        key = (addr, sid and int.from_bytes(sid, 'big'))
+        session = self.sessions.get(key)
+        if session is None:
+            # only the first window of DATA/FIN opens a session
+            if not (packet.type & (Type.DATA | Type.FIN) and int(packet.seq) < self.N):
+                self.stats.rcvd += 1
+                packet.release()
+                return
+            session = Session(self, addr, key[1], self.N, self.seqbits, self.delayed_ack, self.link,
+                              self.queue_bytes)
+            if self.linger is not None:
+                session.timer.set_intv(Ev.TO_Closing, self.linger + LINGER_MARGIN)
+            self.sessions[key] = session
+            self.accept_queue.put(session)
+            logging.info(f'{self.name}: new session {key}')
+        try:
+            session.transition(Ev.Packet_Arrival, session.received(packet))
+        except Exception:
+            self.abort(key)
 
-        Save it into buffer, and scan the rcvbuf.
-        Deliver in-order data to the receiver app.
-        When FIN data(b'') has delivered, mark to notify it to FSM as follow:
-            self.FIN_delivered = True
+    def abort(self, key):
+        """Drop a session whose FSM has failed, ending its data for the app;
+        the other sessions go on
         """
+        logging.exception(f'{self.name}: session {key} failed')
+        self.sessions.pop(key).stream.finish()
 
-        ### Your code here
-        pass
-
-    def fsm(self):
-        start_time = None
+    def window_update(self, session):
+        """Have the listener thread advertise the window the session's app opened;
+        called in the app thread
+        """
+        self.updates.append(session)
+        self.wakeup()
 
-        while self.state != State.Closed:
-            event = self.get_event()
-            if event == Ev.Packet_Arrival:
-                rcvpkt = self.rdt_rcv()
-                self._log(event, rcvpkt)
-            elif event >= Ev.TO_Retransmit: # all timeout events
-                self._log(event)
-            else:
-                logging.error('Unknown event: %d' % event)
+    def advertise(self):
+        """ACK the windows the apps opened, for the sessions still there"""
+        try:
+            while self._wakeup_r.recv(512):
+                pass
+        except BlockingIOError:
+            pass
+        updates = self.updates
+        while updates:
+            session = updates.popleft()
+            key = (session.peer, session.sid)
+            if self.sessions.get(key) is not session:   # removed already
                 continue
+            try:
+                session.transition(Ev.App_Request, None)
+            except Exception:
+                self.abort(key)
+
+    def transmit(self, buffers, addr, delay=0.):
+        """Send to the session's peer, or after the delay without blocking the sessions"""
+        if delay > 0:
+            heapq.heappush(self.delayed, (time.monotonic() + delay, next(self._order), buffers, addr))
+        else:
+            sendmsg(self.sock, buffers, addr)
 
-            if start_time is None:
-                start_time = time.time()
+    def send_delayed(self):
+        """Send the delayed packets due
 
-            # state transition
-            if self.state == State.Wait:
-                ### Your code here
+        :return: time to send the next one, None if none left
+        """
+        delayed = self.delayed
+        now = time.monotonic()
+        while delayed and delayed[0][0] <= now:
+            _, _, buffers, addr = heapq.heappop(delayed)
+            sendmsg(self.sock, buffers, addr)
+        return delayed[0][0] if delayed else None
+
+    def receive_all(self, count=MAX_BATCH):
+        """Dispatch the packets queued in the socket, up to count"""
+        self.dispatch(*self.pool.recvfrom(self.sock))
+        if _DONTWAIT:
+            try:
+                for _ in range(count - 1):
+                    self.dispatch(*self.pool.recvfrom(self.sock, _DONTWAIT))
+            except BlockingIOError:
                 pass
 
-                continue
+    def expire(self):
+        """Run timeout events of the sessions, removing the closed ones
 
-            # Whenever GBNsend do not receive the final ACK,
-            # duplicated FIN might be coming.
-            if self.state == State.Closing:
-                if event == Ev.TO_Closing:         # termination timer timeout
-                    self.state = State.Closed
-                elif event == Ev.Packet_Arrival:
-                    self.feedback_ACK()  # retransmit
+        :return: nearest deadline among the sessions, None if no timer is running
+        """
+        nearest = None
+        for key, session in list(self.sessions.items()):
+            try:
+                while (event := session.timer.check_timeout()):
+                    session.transition(event)
+            except Exception:
+                self.abort(key)
                 continue
-        # end of while loop
-
-        # Closed state
-        self.stats.elapsed = time.time() - start_time
-        self._log()
-
+            if session.state == State.Closed:
+                self.sessions.pop(key).stream.finish()    # ended for the app
+                continue
+            deadline = session.timer.next_deadline()
+            if deadline is not None and (nearest is None or deadline < nearest):
+                nearest = deadline
+        return nearest
 
+    #  thread.start() calls this method
+    def run(self):
+        logging.info(f'{self.name} starts')
+        timeout = None
+        while not self.closing:
+            for key, mask in self.selector.select(timeout):
+                if key.fileobj is self.sock:
+                    self.receive_all()
+                else:
+                    self.advertise()
+            deadline = self.expire()
+            delayed = self.send_delayed()
+            if delayed is not None and (deadline is None or delayed < deadline):
+                deadline = delayed
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0.)
+        for session in self.sessions.values():  # abandoned: their data end for the apps
+            session.stream.finish()
+        self.selector.close()
+        for sock in (self.sock, self._wakeup_r, self._wakeup_w):
+            sock.close()
+        logging.info(f'{self.name} terminates')
@@ -0,0 +1,170 @@
+# Metrics of the GBN protocol entities:
+# counters and histograms in Statistics, and an optional ring-buffer trace of events.
+# Histograms cost a bisect per sample; the trace costs nothing unless attached.
+
+import sys, bisect
+from collections import deque
+
+
+def exponential(start, factor, count):
+    """Bucket upper bounds growing geometrically"""
+    return [start * factor ** i for i in range(count)]
+
+
+class Histogram:
+    """Samples counted in buckets by upper bound, with count/sum/min/max
+    """
+    __slots__ = ('bounds', 'buckets', 'count', 'sum', 'min', 'max')
+
+    def __init__(self, bounds):
+        """
+        :param bounds: ascending bucket upper bounds; samples above the last go to an overflow bucket
+        """
+        self.bounds = list(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.min = self.max = None
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile(0-100), clamped to min and max"""
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.buckets):
+            seen += n
+            if seen >= rank:
+                return max(self.min, min(bound, self.max))
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'p50': self.percentile(50), 'p99': self.percentile(99),
+                'bounds': self.bounds, 'buckets': self.buckets}
+
+
+class Statistics:
+    """statistics about packet exchange
+    """
+    def __init__(self):
+        self.sent = self.dropping = self.corrupting = 0   # for packet transmission
+        self.rcvd = self.corrupt = 0    # for packets reception
+        self.elapsed = None
+        # for retransmit timeout at the sending side
+        self.rtt = Histogram(exponential(0.0001, 2, 18))    # RTT samples(in seconds): 0.1 ms ~ 13 s
+        self.timeouts = self.spurious = self.fast_retransmits = 0
+        self.sack_skipped = self.sack_saved = 0    # retransmissions saved by SACK
+        self.acks = self.acks_suppressed = 0    # at the receiving side
+        self.acks_dropped = self.acks_coalesced = 0     # on the ACK fast path of the sending side
+        self.parity_sent = self.fec_recovered = 0   # FEC parity packets, and packets rebuilt
+        self.app_bytes = self.wire_bytes = 0    # app data, and DATA payload carrying it
+        # packets outstanding after each send, and seconds the data waited in the send buffer
+        self.window = Histogram(exponential(1, 2, 16))
+        self.queue_wait = Histogram(exponential(0.0001, 2, 18))
+
+    @property
+    def rtt_count(self): return self.rtt.count
+
+    @property
+    def rtt_min(self): return self.rtt.min
+
+    @property
+    def rtt_max(self): return self.rtt.max
+
+    def add_rtt(self, rtt):
+        self.rtt.add(rtt)
+
+    def as_dict(self):
+        """Counters and histograms, for exporting"""
+        return {key: value.as_dict() if isinstance(value, Histogram) else value
+                for key, value in vars(self).items()}
+
+    def __str__(self):
+        s = f"""Packets sent: {self.sent} (dropping: {self.dropping}, corrupting: {self.corrupting})
+Packets rcvd: {self.rcvd} (corrupt: {self.corrupt})"""
+        rtt = self.rtt
+        if rtt.count:
+            s += f"""
+RTT samples: {rtt.count} (min/avg/p99/max: {rtt.min * 1000:.3f}/{rtt.mean * 1000:.3f}/\
+{rtt.percentile(99) * 1000:.3f}/{rtt.max * 1000:.3f} msec)"""
+        if self.window.count:
+            s += f"""
+Window occupancy: avg {self.window.mean:.1f}, p99 {self.window.percentile(99)}, \
+max {self.window.max} packets"""
+        if self.queue_wait.count:
+            s += f"""
+Send buffer wait: p50 {self.queue_wait.percentile(50) * 1000:.3f}, \
+p99 {self.queue_wait.percentile(99) * 1000:.3f} msec"""
+        if self.timeouts:
+            s += f"""
+Timeouts: {self.timeouts} (spurious: {self.spurious})"""
+        if self.fast_retransmits:
+            s += f"""
+Fast retransmits: {self.fast_retransmits}"""
+        if self.sack_skipped:
+            s += f"""
+SACKed, not retransmitted: {self.sack_skipped} packets ({self.sack_saved} bytes saved)"""
+        if self.acks_dropped or self.acks_coalesced:
+            s += f"""
+ACKs dropped on the fast path: {self.acks_dropped} stale or duplicate, \
+{self.acks_coalesced} superseded"""
+        if self.app_bytes:
+            s += f"""
+App bytes: {self.app_bytes} in {self.wire_bytes} bytes of DATA payload \
+({self.wire_bytes / self.app_bytes:.1%})"""
+        if self.parity_sent:
+            s += f"""
+Parity packets sent: {self.parity_sent}"""
+        if self.fec_recovered:
+            s += f"""
+Packets rebuilt from parity: {self.fec_recovered}"""
+        if self.acks_suppressed:
+            s += f"""
+ACKs sent: {self.acks} (suppressed by delayed ACK: {self.acks_suppressed})"""
+        return s + f"""
+Time elapsed: {self.elapsed} sec"""
+
+
+class Trace:
+    """Ring buffer of the latest FSM events, dumped on demand
+    Entries are (time, state, event, base, detail); detail is a packet summary
+    (type, seq, length), the length of app data, or None.
+    """
+    def __init__(self, size=4096):
+        self.events = deque(maxlen=size)
+
+    def add(self, time, state, event, base, chunk):
+        if hasattr(chunk, 'hdr'):       # packet: not kept, its buffer is reused
+            detail = (chunk.hdr[0], chunk.hdr[1], len(chunk))
+        elif isinstance(chunk, (bytes, bytearray)):
+            detail = len(chunk)
+        else:
+            detail = None
+        self.events.append((time, state, event, base, detail))
+
+    def export(self):
+        """Events as a list of dicts, oldest first"""
+        return [{'time': time, 'state': state.name, 'event': event.name if event else None,
+                 'base': int(base), 'detail': detail}
+                for time, state, event, base, detail in self.events]
+
+    def dump(self, file=None):
+        """Print the events, oldest first"""
+        file = file or sys.stderr
+        for e in self.export():
+            print(f'{e["time"]:.6f} {e["state"]} {e["event"] or ""} {e["base"]} '
+                  f'{e["detail"] if e["detail"] is not None else ""}', file=file)
@@ -0,0 +1,83 @@
+# Link emulator for the GBN protocol entities
+# Decides for each packet sent whether it is lost, corrupted, duplicated,
+# and when it arrives. The transports deliver it at that time:
+# a delay queue in the threads(gbn.py), call_at on the event loop(aiogbn.py),
+# or the virtual clock of the in-memory simulator(sim.py).
+
+import random
+
+
+class Link:
+    """One direction of an emulated link, with its own seeded RNG
+    """
+    def __init__(self, loss=0., corrupt=0., delay=0., jitter=0., rate=None, limit=None,
+                 reorder=0., duplicate=0., burst=None, seed=None):
+        """
+        :param loss: packet loss rate(in the good state, if burst is given)
+        :param corrupt: packet error rate, flipping a bit
+        :param delay: fixed one-way delay(in seconds)
+        :param jitter: mean of an extra exponential-variate delay(in seconds)
+        :param rate: bandwidth cap in bytes/sec, unlimited if None
+        :param limit: max bytes queued for the bandwidth cap, dropping the rest(drop-tail);
+                      unlimited if None
+        :param reorder: probability that a packet skips the delay, passing the ones in flight
+        :param duplicate: probability that a packet arrives twice
+        :param burst: Gilbert-Elliott burst loss (p, r, bad_loss): p is the probability
+                      of going from the good to the bad state, r of coming back, and
+                      bad_loss the loss rate in the bad state
+        :param seed: seed of the RNG, for reproducible runs
+        """
+        self.loss = loss
+        self.corrupt = corrupt
+        self.delay = delay
+        self.jitter = jitter
+        self.rate = rate
+        self.limit = limit
+        self.reorder = reorder
+        self.duplicate = duplicate
+        self.burst = burst
+        self.rng = random.Random(seed)
+        self.bad = False        # Gilbert-Elliott state
+        self.busy_until = 0.    # when the bottleneck finishes the packets queued
+
+    def __repr__(self):
+        return f'Link(loss={self.loss}, corrupt={self.corrupt}, delay={self.delay}, ' \
+               f'jitter={self.jitter}, rate={self.rate})'
+
+    def lost(self):
+        """Whether the next packet is lost, stepping the burst loss model"""
+        rng = self.rng
+        if self.burst is None:
+            return self.loss > 0 and rng.random() < self.loss
+        p, r, bad_loss = self.burst
+        if self.bad:
+            if rng.random() < r:
+                self.bad = False
+        elif rng.random() < p:
+            self.bad = True
+        return rng.random() < (bad_loss if self.bad else self.loss)
+
+    def emulate(self, size, now):
+        """Fate of a packet sent now
+
+        :param size: packet size in bytes
+        :param now: current time, on the sender's clock
+        :return: list of (delay from now, corrupted) for each copy arriving,
+                 empty if the packet is lost
+        """
+        rng = self.rng
+        if self.lost():
+            return []
+        delay = 0.
+        if self.rate:       # serialized at the bottleneck
+            start = max(now, self.busy_until)
+            if self.limit is not None and (start - now) * self.rate > self.limit:
+                return []   # queue overflow
+            self.busy_until = start + size / self.rate
+            delay = self.busy_until - now
+        if not (self.reorder > 0 and rng.random() < self.reorder):
+            delay += self.delay
+            if self.jitter > 0:
+                delay += rng.expovariate(1.0 / self.jitter)
+        copies = 2 if self.duplicate > 0 and rng.random() < self.duplicate else 1
+        return [(delay, self.corrupt > 0 and rng.random() < self.corrupt) for _ in range(copies)]
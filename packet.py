@@ -1,52 +1,84 @@
-from enum import IntFlag
+import struct
+from enum import IntEnum, IntFlag
 
 
-class Seq:
-    """8-bit Wrap-around sequence number"""
+class Seq(int):
+    """8-bit Wrap-around sequence number
+
+    An int kept in [0, MOD), so it is hashable and usable as an index like an int,
+    with wrap-around arithmetic and comparison.
+    seqclass(bits) gives the wider ones, e.g. Seq16 and Seq32.
+    """
+    __slots__ = ()
+    BITS = 8
     MOD = 1 << 8  # 8 bit sequence number
+    MASK = MOD - 1
     HALF = MOD >> 1
+    _cache = None   # interned instances of narrow sequence numbers
 
-    def __init__(self, number):
-        if not isinstance(number, int):
-            raise TypeError('not int type')
-        self.seq = number % Seq.MOD
-
-    def __repr__(self): return 'Seq({})'.format(self.seq)
+    def __new__(cls, number):
+        if cls._cache is not None:
+            return cls._cache[number % cls.MOD]
+        return int.__new__(cls, number % cls.MOD)
 
-    def __str__(self): return str(self.seq)
+    def __repr__(self): return f'{self.__class__.__name__}({int.__repr__(self)})'
 
-    def __int__(self): return self.seq  # int conversion
+    __str__ = int.__repr__
 
+    # The arithmetic works on -self and -n, plain ints, so it runs in C
+    # without going through the methods below again.
     def __add__(self, n:int):
         """Forward n steps"""
-        if not isinstance(n, int):
-            raise TypeError('not int type')
-        return Seq(self.seq + n)
+        number = (n - -self) & self.MASK
+        if self._cache is not None:
+            return self._cache[number]
+        return int.__new__(self.__class__, number)
 
-    def __sub__(self, n:int):
-        """Backward n steps"""
-        if not isinstance(n, int):
-            raise TypeError('not int type')
-        return Seq(self.seq - n)
+    __radd__ = __add__
 
-    def __eq__(self, other):
-        if not isinstance(other, Seq):
-            raise TypeError('not Seq type')
-        return self.seq == other.seq
+    def __sub__(self, n:int):
+        """Backward n steps, or the distance from Seq n"""
+        number = (-n - -self) & self.MASK
+        if self._cache is not None:
+            return self._cache[number]
+        return int.__new__(self.__class__, number)
 
+    # other - self(= s - o) is measured forward, wrapping around when negative
     def __lt__(self, other):
-        if not isinstance(other, Seq):
-            raise TypeError('not Seq type')
-        return (self.seq < other.seq and other.seq - self.seq < Seq.HALF) or \
-               (self.seq > other.seq and self.seq - other.seq > Seq.HALF)
+        s, o = -self, -other
+        return 0 < s - o < self.HALF if s >= o else o - s > self.HALF
+
+    def __le__(self, other):
+        s, o = -self, -other
+        return s - o < self.HALF if s >= o else o - s > self.HALF
+
+    def __ge__(self, other):
+        s, o = -self, -other
+        return not (0 < s - o < self.HALF if s >= o else o - s > self.HALF)
 
-    def __ne__(self, other): return not self.__eq__(other)
+    def __gt__(self, other):
+        s, o = -self, -other
+        return not (s - o < self.HALF if s >= o else o - s > self.HALF)
 
-    def __ge__(self, other): return not self.__lt__(other)
 
-    def __le__(self, other): return self.__lt__(other) or self.__eq__(other)
+Seq._cache = tuple(int.__new__(Seq, i) for i in range(Seq.MOD))
 
-    def __gt__(self, other): return not self.__le__(other)
+_seqclasses = {8: Seq}
+
+
+def seqclass(bits=8):
+    """Sequence number type of the given width
+
+    :param bits: 8, 16 or 32
+    :return: Seq or its subclass
+    """
+    if bits not in _seqclasses:
+        if bits not in (16, 32):
+            raise ValueError('bits: not 8, 16 or 32')
+        _seqclasses[bits] = type(f'Seq{bits}', (Seq,), dict(
+            __slots__=(), BITS=bits, MOD=1 << bits, MASK=(1 << bits) - 1, HALF=1 << (bits - 1),
+            _cache=None))
+    return _seqclasses[bits]
 
 
 def srange(start:Seq, end:Seq):
@@ -54,10 +86,8 @@ def srange(start:Seq, end:Seq):
     """
     if not (isinstance(start, Seq) and isinstance(end, Seq)):
         raise TypeError('not Seq type')
-    seq = Seq(start.seq)
-    while seq != end:
-        yield seq
-        seq += 1
+    first = int(start)
+    return map(start.__class__, range(first, first + int(end - start)))
 
 
 class Type(IntFlag):
@@ -66,47 +96,131 @@ class Type(IntFlag):
     DATA    = 1
     ACK     = 2
     FIN     = 4
-    # SYN     = 8
-    # RST     = 16
-    # URG     = 32
-    # PSH     = 64
+    SACK    = 8     # DATA: selective ACKs wanted, ACK: selective ACKs supported
+    PARITY  = 16    # DATA: FEC wanted, ACK: FEC supported, alone: parity of a block(see Parity)
+    ZIP     = 32    # DATA: payload compressed(see Opt.ZIP), ACK: compression accepted
+    PSH     = 64    # DATA: last segment of a message
+    EXT     = 128   # header options follow the fixed header
+
+
+class Opt(IntEnum):
+    """Header option kinds, carried when Type.EXT is set
+
+    Options area: total length(1 byte) followed by kind(1), length(1), value options,
+    zero-padded to keep the header length even.
+    """
+    PAD     = 0
+    SID     = 1     # session id: 4 bytes
+    SEQ     = 2     # sequence number wider than 8 bits: 2 or 4 bytes
+    SACK    = 3     # selective ACK blocks: (start, end) seq pairs in the seq width
+    WND     = 4     # receive window: free bytes in the receiver's buffer, 4 bytes
+    ZIP     = 5     # compression offered by the sender: codec id, 1 byte(1: zlib)
+
+
+def ichecksum(data, sum=0):
+    """Internet Checksum of data(bytes-like), as a 16-bit one's complement sum
+
+    Since 2**16 == 1 (mod 0xFFFF), the sum of big-endian 16-bit words folds to the
+    value of the whole data as a big-endian integer modulo 0xFFFF, which int.from_bytes
+    computes in C instead of a Python loop over the byte pairs.
+    Note: an odd trailing byte is added as a low-order byte.
+    """
+    n = len(data)
+    if n & 1:
+        n -= 1
+        sum += data[n]
+    sum += int.from_bytes(memoryview(data)[:n], 'big')
+    if sum:     # take only 16 bits adding up the carries, but never fold a nonzero sum to 0
+        sum = (sum - 1) % 0xFFFF + 1
+    # one's complement the result
+    return ~sum & 0xFFFF
+
+
+_header = struct.Struct('!BBH')     # type, seq(low 8 bits), checksum
+
+
+def parse_header(pdu):
+    """Type, seq and options of a raw packet, without making a Packet, for fast paths
+
+    :param pdu: raw packet(bytes-like) of 4 bytes or more
+    :return: (type, seq number as an int, its width in bits, dict of options or None),
+        or None if the options area is malformed
+    """
+    type, seq, _ = _header.unpack_from(pdu)
+    if not type & Type.EXT:
+        return type, seq, 8, None
+    if len(pdu) <= 4 or 5 + pdu[4] > len(pdu):
+        return None
+    options = decode_options(pdu[5:5 + pdu[4]])
+    wide = options.get(Opt.SEQ)
+    if wide:
+        return type, int.from_bytes(wide, 'big'), 8 * len(wide), options
+    return type, seq, 8, options
 
 
 class Packet:
-    def __init__(self, pdu, seq=None, data=b''):
+    """Packet as a header and a payload buffer, both of which may be views
+    over other buffers: payload given to make a packet is not copied, and a
+    received packet is a view over the receive buffer(see BufferPool).
+    """
+    __slots__ = ('hdr', 'payload', 'pool', 'buf')
+
+    def __init__(self, pdu, seq=None, data=b'', options=None):
         """Make a Packet object from the raw packet(bytes or bytearray)
         or sequence, packet_type, data
-            Packet(pdu)     - convert pdu(bytes/bytearray type) to Packet object
+            Packet(pdu)     - convert pdu(bytes/bytearray/memoryview type) to Packet object
             Packet(type, seq)   - no data
             Packet(type, seq, data)
+            Packet(type, seq, data, options)
 
-        :param pdu: bytes/bytearray or packet type
+        :param pdu: bytes/bytearray/memoryview or packet type
         :param seq: sequence number: int or Seq type
-        :param data: data if any: bytes or bytearray
+        :param data: data if any: bytes, bytearray or memoryview
+        :param options: header options if any: dict of Opt to bytes
         """
+        self.pool = self.buf = None
         if seq is None:
-            if not isinstance(pdu, (bytes, bytearray)):
-                raise TypeError('pdu: not byte/bytearray type')
-            self.pdu = pdu
+            if not isinstance(pdu, (bytes, bytearray, memoryview)):
+                raise TypeError('pdu: not byte/bytearray/memoryview type')
+            pdu = memoryview(pdu)
+            hlen = 5 + pdu[4] if len(pdu) > 4 and pdu[0] & Type.EXT else 4
+            self.hdr = pdu[:hlen]
+            self.payload = pdu[hlen:]
             return
         if not isinstance(seq, (int, Seq)):
             raise TypeError('seq: not int/Seq type')
-        if not isinstance(data, (bytes, bytearray)):
-            raise TypeError('data: not bytes/bytearray type')
-        self.pdu = bytearray([pdu, int(seq), 0, 0])  # header clearing checksum field
-        self.pdu.extend(data)
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            raise TypeError('data: not bytes/bytearray/memoryview type')
+        if isinstance(seq, Seq) and seq.BITS > 8:   # extended header with the wide seq
+            options = dict(options or {})
+            options[Opt.SEQ] = int(seq).to_bytes(seq.BITS // 8, 'big')
+        if options:
+            pdu |= Type.EXT
+        self.hdr = bytearray([pdu, int(seq) & 0xFF, 0, 0])  # header clearing checksum field
+        if options:
+            self.hdr.extend(encode_options(options))
+        self.payload = data
         checksum = self.ichecksum()
-        self.pdu[2:4] = bytearray([checksum >> 8, checksum & 0xFF])  # put the checksum
+        self.hdr[2:4] = bytearray([checksum >> 8, checksum & 0xFF])  # put the checksum
 
     def __repr__(self):
-        return repr(self.pdu) if len(self.pdu) <= 16 else (repr(self.pdu[:16]) + '...')
+        pdu = self.pdu
+        return repr(pdu) if len(pdu) <= 16 else (repr(pdu[:16]) + '...')
 
     def __str__(self):
-        # try:
-        #     pdu_name = Type(self.pdu[0]).name
-        # except:
-        #     pdu_name = str(self.pdu[0])
-        return f'{Type(self.pdu[0]).name} {self.pdu[1]} {bytes(self.pdu[:16])}'
+        return f'{Type(self.hdr[0]).name} {self.hdr[1]} {bytes(self.pdu[:16])}'
+
+    def __len__(self): return len(self.hdr) + len(self.payload)
+
+    @property
+    def pdu(self) -> bytearray:
+        """Raw packet: a copy joining header and payload"""
+        return bytearray(self.hdr) + self.payload
+
+    @property
+    def buffers(self):
+        """Header and payload buffers, for scatter/gather I/O"""
+        return [self.hdr, self.payload]
 
     def ichecksum(self, sum=0):
         """ Compute the Internet Checksum of the supplied data.  The checksum is
@@ -115,73 +229,279 @@ class Packet:
         in the checksum field of the packet and the data.  If the result is zero,
         then the checksum has not detected an error.
         """
-        pdu = self.pdu
-        if not isinstance(pdu, (bytes, bytearray)):
-            raise TypeError('Packet type should be bytes or bytearray')
-
-        for i in range(0, len(pdu), 2):
-            if i + 1 >= len(pdu):
-                sum += pdu[i]
-            else:
-                sum += (pdu[i] << 8) + pdu[i+1]
-        # take only 16 bits out of the 32 bit sum and add up the carries
-        while (sum >> 16) > 0:
-            sum = (sum & 0xFFFF) + (sum >> 16)
-        # one's complement the result
-        sum = ~sum
-        return sum & 0xFFFF
-
-    def extract(self): return self.pdu[4:]
+        if len(self.hdr) & 1:  # malformed header: words of payload not aligned
+            return ichecksum(self.pdu, sum)
+        # header of even length is summed as one more big-endian number
+        return ichecksum(self.payload, sum + int.from_bytes(self.hdr, 'big'))
+
+    def extract(self): return self.payload
 
     def corrupt(self): return self.ichecksum() != 0
 
-    def __getattr__(self, item):
-        """Get type, seq, checksum, data field from the packet
+    def release(self):
+        """Return the receive buffer to its pool; the packet must not be used any more"""
+        if self.buf is not None:
+            self.hdr = self.payload = b''
+            self.pool.put(self.buf)
+            self.pool = self.buf = None
+
+    # type, seq, checksum, data, options field of the packet
+    @property
+    def type(self): return Type(self.hdr[0])
+
+    @property
+    def seq(self):
+        if self.hdr[0] & Type.EXT:
+            wide = self.options.get(Opt.SEQ)
+            if wide:
+                return seqclass(8 * len(wide))(int.from_bytes(wide, 'big'))
+        return Seq(self.hdr[1])
+
+    @property
+    def checksum(self): return self.hdr[2:4]
+
+    @property
+    def data(self): return self.payload
+
+    @property
+    def options(self):
+        return decode_options(self.hdr[5:]) if self.hdr[0] & Type.EXT else {}
+
+
+class Parity:
+    """XOR parity of a block of consecutive DATA packets, from which any one of them
+    is rebuilt with the others
+
+    Parity packet: seq of the first packet in the block, and as payload the number of
+    packets(1 byte), XOR of their types(1) and of their payload lengths(2), then XOR of
+    their payloads zero-padded to the longest.
+    """
+    __slots__ = ('seq', 'count', 'types', 'lengths', 'size', 'xor')
+
+    def __init__(self, seq, payload=None):
         """
-        if item == 'type':
-            return Type(self.pdu[0])
-        elif item == 'seq':
-            return Seq(self.pdu[1])
-        elif item == 'checksum':
-            return self.pdu[2:3]
-        elif item == 'data':
-            return self.pdu[4:]
-        else:
-            raise AttributeError
+        :param seq: seq of the first packet in the block
+        :param payload: payload of a parity packet received, an empty block if None
+        """
+        self.seq = seq
+        if payload is None:
+            self.count = self.types = self.lengths = self.size = self.xor = 0
+            return
+        self.count, self.types = payload[0], payload[1]
+        self.lengths = int.from_bytes(payload[2:4], 'big')
+        self.size = len(payload) - 4
+        self.xor = int.from_bytes(payload[4:], 'little')
+
+    def add(self, packet):
+        """XOR the packet in the parity, or out of it"""
+        payload = packet.payload
+        self.types ^= packet.hdr[0] & ~int(Type.EXT)
+        self.lengths ^= len(payload)
+        self.size = max(self.size, len(payload))
+        # little-endian, so that the zero padding is the high-order bytes
+        self.xor ^= int.from_bytes(payload, 'little')
+
+    def payload(self):
+        return bytes([self.count, self.types]) + self.lengths.to_bytes(2, 'big') \
+            + self.xor.to_bytes(self.size, 'little')
+
+    def rebuild(self, seq):
+        """The packet left in the parity, once all the others in the block are XORed out"""
+        return Packet(self.types, seq, self.xor.to_bytes(self.size, 'little')[:self.lengths])
+
+
+class BufferPool:
+    """Preallocated receive buffers, recycled by Packet.release()
+    """
+    __slots__ = ('size', 'free', 'maxfree')
+
+    def __init__(self, size=2048, count=0, maxfree=1024):
+        """
+        :param size: bytes of each buffer
+        :param count: number of buffers to preallocate
+        :param maxfree: max number of free buffers kept for reuse
+        """
+        self.size = size
+        self.free = [bytearray(size) for _ in range(count)]
+        self.maxfree = maxfree
+
+    def get(self) -> bytearray:
+        return self.free.pop() if self.free else bytearray(self.size)
+
+    def put(self, buf: bytearray):
+        if len(self.free) < self.maxfree:
+            self.free.append(buf)
+
+    def recv(self, sock, flags=0):
+        """Receive a packet from the socket into a pooled buffer
+
+        :param flags: recv flags, like socket.MSG_DONTWAIT
+        :return: Packet viewing the buffer; release() it when done
+        """
+        return self.packet(self.recv_pdu(sock, flags))
+
+    def recv_pdu(self, sock, flags=0):
+        """Receive a raw packet from the socket into a pooled buffer, not parsed
+
+        :param flags: recv flags, like socket.MSG_DONTWAIT
+        :return: memoryview over the buffer; make it a packet(), or put(pdu.obj) it back
+        """
+        buf = self.get()
+        try:
+            n = sock.recv_into(buf, 0, flags)
+        except OSError:
+            self.put(buf)
+            raise
+        return memoryview(buf)[:n]
+
+    def packet(self, pdu):
+        """Packet viewing a raw packet from recv_pdu, returning the buffer when released"""
+        packet = Packet(pdu)
+        packet.pool, packet.buf = self, pdu.obj
+        return packet
+
+    def recvfrom(self, sock, flags=0):
+        """Receive a packet from the unconnected socket into a pooled buffer
+
+        :param flags: recv flags, like socket.MSG_DONTWAIT
+        :return: (Packet viewing the buffer, peer address)
+        """
+        buf = self.get()
+        try:
+            n, addr = sock.recvfrom_into(buf, 0, flags)
+        except OSError:
+            self.put(buf)
+            raise
+        packet = Packet(memoryview(buf)[:n])
+        packet.pool, packet.buf = self, buf
+        return packet, addr
+
+
+def encode_options(options: dict) -> bytearray:
+    """Encode header options into the options area"""
+    area = bytearray(1)
+    for kind, value in options.items():
+        area.extend([kind, len(value)])
+        area.extend(value)
+    if len(area) % 2 == 1:     # fixed header(4) + options area should be even
+        area.append(Opt.PAD)
+    if len(area) > 256:
+        raise ValueError('options: too long')
+    area[0] = len(area) - 1
+    return area
+
+
+def decode_options(area) -> dict:
+    """Decode the options area (without the length byte) into a dict of Opt to bytes"""
+    options = {}
+    i = 0
+    while i + 1 < len(area) and area[i] != Opt.PAD:
+        kind, length = area[i], area[i+1]
+        options[kind] = bytes(area[i+2:i+2+length])
+        i += 2 + length
+    return options
 
 
 class PacketBuffer:
     """Packet buffers indexed by Seq bumber for GBNsend's send buffer or GBNrecv's receive buffer
-    Note: for indexing, gbn.base attribute is used.
-        popleft method updates gbn.base variable
+    Note: a ring buffer of bufsize cells for the window [base, base + bufsize).
+        popleft/advance_base methods move the window forward, and the FSM
+        should keep its base variable same as the buffer's base.
     """
-    def __init__(self, bufsize: int):
+    __slots__ = ('cells', 'bufsize', 'base', 'head', 'bitmap')
+
+    def __init__(self, bufsize: int, base: Seq = Seq(0)):
         """Packet buffer for GBNsend's send buffer or GBNrecv's receive buffer
 
         :param bufsize: number of pacekt cells in the buffer
+        :param base: first sequence number of the window
         """
-        self.buf = dict([(i, None) for i in range(Seq.MOD)])  # None mean empty packet
-        self.base = Seq(0)
+        self.cells = None   # list of bufsize cells, None mean empty packet; allocated when used
         self.bufsize = bufsize
+        self.base = base
+        self.head = 0       # cell index of base
+        self.bitmap = 0     # bit i is set if the cell for base + i is occupied
 
     def __str__(self):
-        l = [(Seq(seq), str(pkt)) for seq, pkt in self.buf.items() if pkt]
-        l.sort()
-        ll = [str(s) + ': ' + p for s, p in l]
-        return '\n'.join(ll)
+        return '\n'.join(str(s) + ': ' + str(p) for s, p in self)
+
+    def __len__(self):
+        """Number of occupied cells"""
+        return bin(self.bitmap).count('1')
+
+    def __iter__(self):
+        """Iterate (seq, packet) over occupied cells in sequence order"""
+        base, head, size, cells = self.base, self.head, self.bufsize, self.cells
+        bitmap = self.bitmap
+        while bitmap:
+            i = (bitmap & -bitmap).bit_length() - 1     # lowest occupied offset
+            bitmap &= bitmap - 1
+            yield base + i, cells[(head + i) % size]
+
+    def _offset(self, seq: Seq):
+        if not isinstance(seq, Seq):
+            raise TypeError('not Seq type')
+        return int.__sub__(seq, self.base) % self.base.MOD
 
     def __getitem__(self, seq:Seq)-> Packet:
-        self._check_key(seq)
-        return self.buf[seq.seq]
+        i = self._offset(seq)
+        if i >= self.bufsize or self.cells is None:
+            return None     # out of the window, or none stored yet
+        return self.cells[(self.head + i) % self.bufsize]
 
     def __setitem__(self, seq:Seq, item:Packet):
-        self._check_key(seq)
-        self.buf[seq.seq] = item
+        i = self._offset(seq)
+        if i >= self.bufsize:
+            raise IndexError(f'{seq}: out of the window from {self.base}')
+        if self.cells is None:
+            self.cells = [None] * self.bufsize
+        self.cells[(self.head + i) % self.bufsize] = item
+        self.bitmap |= 1 << i
 
     def __delitem__(self, seq:Seq):
-        self._check_key(seq)
-        self.buf[seq.seq] = None
-
-    def _check_key(self, seq: Seq):
-        if not isinstance(seq, Seq):
-            raise TypeError('not Seq type')
+        i = self._offset(seq)
+        if i < self.bufsize and self.cells is not None:
+            self.cells[(self.head + i) % self.bufsize] = None
+            self.bitmap &= ~(1 << i)
+
+    def runs(self):
+        """Iterate (start, end) of contiguous occupied cells [start, end) in sequence order"""
+        base, bitmap = self.base, self.bitmap
+        while bitmap:
+            start = (bitmap & -bitmap).bit_length() - 1
+            x = bitmap >> start
+            n = (x ^ (x + 1)).bit_length() - 1      # number of occupied cells from start
+            bitmap &= ~(((1 << n) - 1) << start)
+            yield base + start, base + start + n
+
+    def popleft(self) -> Packet:
+        """Remove the packet at base, if any, and move base one step forward"""
+        packet = None
+        if self.bitmap & 1:
+            packet = self.cells[self.head]
+            self.cells[self.head] = None
+        self.head = (self.head + 1) % self.bufsize
+        self.bitmap >>= 1
+        self.base += 1
+        return packet
+
+    def advance_base(self, seq: Seq):
+        """Remove the packets in [base, seq) and move base to seq
+
+        :return: number of packets removed
+        """
+        n = self._offset(seq)
+        if n >= self.bufsize:
+            self.cells = None
+            removed = len(self)
+            self.bitmap = self.head = 0
+        else:
+            removed = bin(self.bitmap & ((1 << n) - 1)).count('1')
+            cells, size = self.cells, self.bufsize
+            if removed:
+                for i in range(self.head, self.head + n):
+                    cells[i % size] = None
+            self.head = (self.head + n) % size
+            self.bitmap >>= n
+        self.base = seq
+        return removed
@@ -12,3 +12,5 @@ while True:
     if data == b'':
         break
     print(data.decode('utf-8'), end='')
+gr.join()
+print(gr.stats)
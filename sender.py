@@ -14,3 +14,5 @@ gs = gbn.open(peer_host='localhost', N=16)
 for line in textlines(500):
     gs.send(line.encode('utf-8'))
 gs.close()
+gs.join()
+print(gs.stats)
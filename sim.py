@@ -0,0 +1,105 @@
+# In-memory simulation of a GBN session on a virtual clock
+# The sender and receiver FSMs exchange packets through emulated links
+# (netem.Link) in one thread, with no sockets. The clock jumps to the next
+# event, so a run takes far less than real time and, with seeded links,
+# is reproducible.
+
+import heapq, itertools
+
+from gbn import Ev, State, Timer, SendFSM, RecvFSM, MSS
+from netem import Link
+
+
+class SimSend(SendFSM):
+    def __init__(self, sim, N, **kwargs):
+        self.sim = sim
+        SendFSM.__init__(self, N, Timer(clock=sim.clock), **kwargs)
+
+    def transmit(self, buffers, delay=0.):
+        self.sim.send(self.sim.receiver, buffers, delay)
+
+
+class SimRecv(RecvFSM):
+    def __init__(self, sim, N, **kwargs):
+        self.sim = sim
+        RecvFSM.__init__(self, N, Timer(clock=sim.clock), **kwargs)
+        self.data = []
+
+    def transmit(self, buffers, delay=0.):
+        self.sim.send(self.sim.sender, buffers, delay)
+
+    def end_message(self):
+        pass    # message boundaries are not recorded
+
+    def deliver(self, data):
+        self.data.append(data)
+        self.sim.delivered.append((self.sim.now, self.sim.delivered[-1][1] + len(data)))
+
+
+class Simulator:
+    """GBN sender and receiver connected by emulated links on a virtual clock
+    """
+    def __init__(self, N, forward=None, reverse=None, seqbits=8, sack=False, cc=None,
+                 delayed_ack=True, mss=MSS, fec=0, compress=0):
+        """
+        :param N: window size of both sides
+        :param forward: netem.Link from the sender to the receiver, perfect if None
+        :param reverse: netem.Link from the receiver to the sender, perfect if None
+        Other parameters are as in gbn.open().
+        """
+        self.now = 0.
+        self.events = []    # min-heap of (time, order, entity, pdu) for packets in flight
+        self._order = itertools.count()
+        # (time, bytes so far) of each app write, and of each delivery to the app
+        self.written = [(0., 0)]
+        self.delivered = [(0., 0)]
+        self.sender = SimSend(self, N, seqbits=seqbits, sack=sack, cc=cc, mss=mss,
+                              link=forward or Link(), fec=fec, compress=compress)
+        self.receiver = SimRecv(self, N, seqbits=seqbits, delayed_ack=delayed_ack,
+                                link=reverse or Link())
+
+    def clock(self):
+        return self.now
+
+    def send(self, entity, buffers, delay=0.):
+        """Deliver a packet to the entity after the delay"""
+        heapq.heappush(self.events, (self.now + delay, next(self._order), entity, b''.join(buffers)))
+
+    def run(self, data, write=MSS, until=None):
+        """Send data from the sender app to the receiver app, then close
+
+        :param data: bytes-like data to send
+        :param write: bytes per app write
+        :param until: virtual seconds to stop at, if not closed by then
+        :return: data received
+        """
+        sender, receiver = self.sender, self.receiver
+        view = memoryview(data)
+        offset = 0
+        while sender.state != State.Closed or receiver.state != State.Closed:
+            # the app writes as fast as the send buffer allows
+            while sender.state == State.Wait and not sender.fin_pending and sender.buffer_open():
+                chunk = bytes(view[offset:offset+write])
+                offset += len(chunk)
+                sender.transition(Ev.App_Request, chunk)    # b'' closes
+                if chunk:
+                    self.written.append((self.now, offset))
+            # advance the clock to the next event
+            deadlines = [t for t in (sender.timer.next_deadline(), receiver.timer.next_deadline())
+                         if t is not None]
+            if self.events:
+                deadlines.append(self.events[0][0])
+            if not deadlines:
+                break       # nothing can happen any more
+            t = min(deadlines)
+            if until is not None and t > until:
+                break
+            self.now = max(self.now, t)
+            events = self.events
+            while events and events[0][0] <= self.now:
+                _, _, entity, pdu = heapq.heappop(events)
+                entity.transition(Ev.Packet_Arrival, entity.make_rcvpkt(pdu))
+            for entity in (sender, receiver):
+                while (event := entity.timer.check_timeout()):
+                    entity.transition(event)
+        return b''.join(receiver.data)
@@ -0,0 +1,201 @@
+# Striped transfer of one large payload over parallel GBN sessions
+# Each of K worker processes runs its own GBN entity on its own port pair,
+# so the FSMs, checksums and socket I/O of the streams use K cores, not one
+# under the GIL. Stream i carries a contiguous shard of the payload after
+# a manifest header, and the receiving side reassembles the shards by them.
+# The payload and the shards are passed through shared memory, not pickled.
+
+import struct, logging, multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+
+import gbn
+
+# port pair of stream i: receiver on STRIPE_PORT + 2i, sender on STRIPE_PORT + 2i + 1
+STRIPE_PORT = 20000
+
+# manifest header at the head of each stream:
+# magic, stream index, number of streams, payload size, shard offset and length
+MANIFEST = struct.Struct('!4sHHQQQ')
+MAGIC = b'GBNS'
+
+
+def open_striped(peer_host, N, streams=4, passive=False, port=STRIPE_PORT, **options):
+    """Open a striped transfer over parallel GBN sessions
+
+    :param peer_host: hostname of the peer
+    :param N: window size of each session
+    :param streams: number of sessions, each in its own worker process
+    :param passive: for sending (default), for receiving if True
+    :param port: first port of the port pairs, STRIPE_PORT + 2 * streams ports in use
+    :param options: as in gbn.open() for the side: seqbits, sack, cc, mss, link, ...
+    :return: StripedSend with send(), or StripedRecv with recv()
+    """
+    assert N <= gbn.seqclass(options.get('seqbits', 8)).HALF, "N: too big"
+    # one tracker for the workers too, so none of them unlinks the blocks passed around
+    resource_tracker.ensure_running()
+    if passive:
+        return StripedRecv(peer_host, N, streams, port, options)
+    return StripedSend(peer_host, N, streams, port, options)
+
+
+def ports(index, port=STRIPE_PORT):
+    """(receiver port, sender port) of the stream"""
+    return port + 2 * index, port + 2 * index + 1
+
+
+def shards(size, streams):
+    """(offset, length) of the contiguous shard of each stream"""
+    step = -(-size // streams)
+    return [(min(i * step, size), max(min(step, size - i * step), 0)) for i in range(streams)]
+
+
+def _send_shard(peer_host, N, index, streams, port, name, size, options, results):
+    """Worker sending its shard of the payload in shared memory"""
+    try:
+        offset, length = shards(size, streams)[index]
+        rport, sport = ports(index, port)
+        gs = gbn.GBNsend((peer_host, rport), N, port=sport, **options)
+        gs.start()
+        shm = shared_memory.SharedMemory(name)
+        try:
+            gs.send(MANIFEST.pack(MAGIC, index, streams, size, offset, length))
+            with shm.buf[offset:offset+length] as shard:
+                gs.sendall(shard)
+        finally:
+            shm.close()
+        closed = gs.close()
+        gs.join()
+        results.put((index, closed, gs.stats.as_dict()))
+    except Exception as e:
+        logging.exception('stripe: stream %d', index)
+        results.put((index, e, None))
+
+
+def _recv_shard(peer_host, N, index, port, options, results):
+    """Worker receiving its shard into a shared memory block, left for the parent to unlink"""
+    try:
+        rport, sport = ports(index, port)
+        gr = gbn.GBNrecv((peer_host, sport), N, port=rport, **options)
+        gr.start()
+        magic, i, streams, size, offset, length = MANIFEST.unpack(gr.readexactly(MANIFEST.size))
+        if magic != MAGIC or i != index:
+            raise ValueError(f'stripe: bad manifest on stream {index}')
+        shm = shared_memory.SharedMemory(create=True, size=max(length, 1))
+        try:
+            got = 0
+            with shm.buf[:length] as shard:
+                while got < length and (n := gr.recv_into(shard[got:])):
+                    got += n
+            if got < length:
+                raise EOFError(f'stripe: stream {index} ended at {got} of {length} bytes')
+            gr.join()
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+        results.put((index, (size, offset, length, shm.name), gr.stats.as_dict()))
+        shm.close()
+    except Exception as e:
+        logging.exception('stripe: stream %d', index)
+        results.put((index, e, None))
+
+
+class StripedSend:
+    """Sending side of striped transfers: one payload per send()
+    """
+    def __init__(self, peer_host, N, streams, port, options):
+        """
+        :param peer_host: hostname of the receiver
+        :param N: send window size of each session
+        :param streams: number of sessions
+        :param port: first port of the port pairs
+        :param options: GBNsend options
+        """
+        self.peer_host = peer_host
+        self.N = N
+        self.streams = streams
+        self.port = port
+        self.options = options
+        self.stats = []     # Statistics.as_dict() of each stream in the last transfer
+
+    def send(self, data, timeout=None):
+        """Send bytes-like data across the streams, waiting until all are ACKnowledged
+
+        :param timeout: seconds to wait for each stream, forever if None
+        :return: True if all the sessions closed, False if any timed out
+        :raise queue.Empty: if a worker did not finish in time
+        """
+        view = memoryview(data).cast('B')
+        results = multiprocessing.Queue()
+        shm = shared_memory.SharedMemory(create=True, size=max(len(view), 1))
+        workers = []
+        try:
+            shm.buf[:len(view)] = view
+            for i in range(self.streams):
+                workers.append(multiprocessing.Process(
+                    target=_send_shard, daemon=True,
+                    args=(self.peer_host, self.N, i, self.streams, self.port, shm.name,
+                          len(view), self.options, results)))
+                workers[-1].start()
+            stats = [None] * self.streams
+            closed = True
+            for _ in workers:
+                index, result, stats[index] = results.get(timeout=timeout)
+                if isinstance(result, Exception):
+                    raise result
+                closed &= result
+            self.stats = stats
+            return closed
+        finally:
+            for w in workers:
+                w.join(timeout)
+            shm.close()
+            shm.unlink()
+
+
+class StripedRecv:
+    """Receiving side of a striped transfer: the workers listen from the start
+    """
+    def __init__(self, peer_host, N, streams, port, options):
+        """
+        :param peer_host: hostname of the sender
+        :param N: receive window size of each session
+        :param streams: number of sessions
+        :param port: first port of the port pairs
+        :param options: GBNrecv options
+        """
+        self.streams = streams
+        self.stats = []     # Statistics.as_dict() of each stream
+        self.results = multiprocessing.Queue()
+        self.workers = [multiprocessing.Process(
+            target=_recv_shard, daemon=True,
+            args=(peer_host, N, i, port, options, self.results)) for i in range(streams)]
+        for w in self.workers:
+            w.start()
+
+    def recv(self, timeout=None):
+        """Receive the payload, reassembled from the shards
+
+        :param timeout: seconds to wait for each stream, forever if None
+        :return: payload (bytearray type)
+        :raise queue.Empty: if a worker did not finish in time
+        """
+        data, stats, error = None, [None] * self.streams, None
+        for _ in self.workers:
+            index, result, stats[index] = self.results.get(timeout=timeout)
+            if isinstance(result, Exception):
+                error = error or result
+                continue
+            size, offset, length, name = result
+            shm = shared_memory.SharedMemory(name)
+            if data is None:
+                data = bytearray(size)
+            data[offset:offset+length] = shm.buf[:length]
+            shm.close()
+            shm.unlink()
+        for w in self.workers:
+            w.join()
+        if error:
+            raise error
+        self.stats = stats
+        return data
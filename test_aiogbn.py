@@ -0,0 +1,69 @@
+# Tests of the asyncio GBN entities over localhost UDP, with perfect emulated links
+
+import asyncio, os
+
+import gbn, aiogbn
+from netem import Link
+from conftest import free_port
+
+
+def test_sessions_to_listener():
+    listener = gbn.GBNListener(('127.0.0.1', 0), 8, link=Link())
+    listener.start()
+    port = listener.sock.getsockname()[1]
+
+    async def send(sid):
+        sender = await aiogbn.open('127.0.0.1', 8, sid=sid, peer_port=port, link=Link(),
+                                   linger=0.1)
+        await sender.send(b'session %d' % sid)
+        await sender.close()
+
+    async def main():
+        await asyncio.gather(*(send(sid) for sid in range(50)))
+    asyncio.run(main())
+    received = {}
+    for _ in range(50):
+        session = listener.accept(timeout=5)
+        received[session.sid] = session.recv(timeout=5)
+    listener.close()
+    assert received == {sid: b'session %d' % sid for sid in range(50)}
+
+
+def test_recv_message_end_of_data():
+    sport, rport = free_port(), free_port()
+
+    async def main():
+        receiver = await aiogbn.open('127.0.0.1', 8, passive=True, link=Link(),
+                                     local_port=rport, peer_port=sport)
+        sender = await aiogbn.open('127.0.0.1', 8, link=Link(), linger=0.1,
+                                   local_port=sport, peer_port=rport)
+        await sender.send_message(b'message')
+        await sender.send(b'rest')
+        await sender.close()
+        return [await receiver.recv_message() for _ in range(3)]
+    assert asyncio.run(main()) == [b'message', b'rest', b'']
+
+
+def test_receive_window_bounded():
+    sport, rport = free_port(), free_port()
+    limit = 4 * gbn.MSS
+    data = os.urandom(100000)
+
+    async def main():
+        receiver = await aiogbn.open('127.0.0.1', 4, passive=True, link=Link(),
+                                     local_port=rport, peer_port=sport, queue_bytes=limit)
+        sender = await aiogbn.open('127.0.0.1', 4, link=Link(), linger=0.1,
+                                   local_port=sport, peer_port=rport)
+        sending = asyncio.create_task(sender.sendall(data))
+        for _ in range(5):     # the reader stalled
+            await asyncio.sleep(0.2)
+            assert len(receiver.stream) <= limit
+        received = b''
+        while (chunk := await receiver.recv(4096)):
+            assert len(chunk) <= 4096
+            received += chunk
+            if len(received) == len(data):
+                await sending
+                await sender.close()
+        return received
+    assert asyncio.run(asyncio.wait_for(main(), 20)) == data
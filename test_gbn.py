@@ -0,0 +1,295 @@
+# Tests of the GBN entities over localhost UDP, with perfect emulated links
+
+import socket, time, os, random, threading
+
+import pytest
+
+import gbn, sim
+from netem import Link
+from packet import Seq, seqclass, Type, Opt, Packet, Parity, ichecksum
+from bench import ichecksum_loop
+from conftest import free_port, NullSend
+
+
+def open_pair(N=8, link=None, queue_bytes=None, linger=0.2):
+    """Started GBNsend and GBNrecv connected to each other"""
+    sport, rport = free_port(), free_port()
+    receiver = gbn.GBNrecv(('127.0.0.1', sport), N, link=Link(), queue_bytes=queue_bytes,
+                           port=rport, linger=linger)
+    sender = gbn.GBNsend(('127.0.0.1', rport), N, link=link or Link(), port=sport, linger=linger)
+    receiver.start()
+    sender.start()
+    return sender, receiver
+
+
+def read_transfer(receiver, timeout=5):
+    """Data of one transfer, up to its end of data"""
+    chunks = []
+    while (data := receiver.recv(timeout=timeout)):
+        chunks.append(data)
+    return b''.join(chunks)
+
+
+def test_send_after_timed_out_close():
+    sender, receiver = open_pair(link=Link(delay=0.1))
+    sender.send(b'first ')
+    assert not sender.close(0.01)   # the FIN still in flight
+    sender.send(b'second')          # the next transfer, once closed
+    assert sender.close(5)
+    assert read_transfer(receiver) == b'first '
+    assert read_transfer(receiver) == b'second'
+    sender.join()
+    receiver.join()
+
+
+def test_zero_window_not_overrun():
+    limit = 16 * gbn.MSS
+    sender, receiver = open_pair(N=16, queue_bytes=limit)
+    data = bytes(range(256)) * 200   # more than the stream buffer, less than all the queues
+    sender.sendall(data)
+    sender.flush()
+    for _ in range(10):     # the reader stalled
+        time.sleep(0.3)
+        assert len(receiver.stream) <= limit
+    assert sender.timer.get_intv(gbn.Ev.TO_Persist) > gbn.TO_interval[gbn.Ev.TO_Persist]
+    received = b''
+    while len(received) < len(data):    # the window opens as the reader goes on
+        received += receiver.recv(timeout=5)
+    assert received == data
+    assert sender.close(5)
+    sender.join()
+    receiver.join()
+
+
+def test_recv_into_file_after_buffered_data(tmp_path):
+    sender, receiver = open_pair(N=16, queue_bytes=8 * gbn.MSS)
+    data = os.urandom(500000)
+    sending = threading.Thread(target=sender.sendall, args=(data,))
+    sending.start()
+    time.sleep(0.2)     # the stream buffer filled before the switch
+    assert len(receiver.stream)
+    closing = threading.Thread(target=lambda: (sending.join(), sender.close(10)))
+    closing.start()
+    path = tmp_path / 'received'
+    assert receiver.recv_into_file(str(path)) == len(data)
+    assert path.read_bytes() == data
+    closing.join()
+    sender.join()
+    receiver.join()
+
+
+def test_app_marks_trimmed_without_window():
+    data = bytes(range(256)) * 4000
+    for compress in (0, 6):     # the simulated receiver advertises no window
+        s = sim.Simulator(16, seqbits=16, compress=compress)
+        assert s.run(data) == data
+        assert not s.sender.app_marks
+
+
+def test_listener_drops_failing_session():
+    listener = gbn.GBNListener(('127.0.0.1', 0), 8, link=Link())
+    listener.start()
+    peer = ('127.0.0.1', listener.sock.getsockname()[1])
+    sid = {Opt.SID: (1).to_bytes(4, 'big')}
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.sendto(Packet(Type.DATA, Seq(0), b'x', options=sid).pdu, peer)
+        failing = listener.accept(timeout=5)
+        assert failing.recv(timeout=5) == b'x'
+
+        def transition(event, chunk=''):
+            raise RuntimeError('session FSM failed')
+        failing.transition = transition
+        sock.sendto(Packet(Type.DATA, Seq(1), b'y', options=sid).pdu, peer)
+        assert failing.recv(timeout=5) == b''   # ended for the app
+    sender = gbn.GBNsend(peer, 8, sid=2, link=Link(), linger=0.1)
+    sender.start()
+    sender.send(b'other session')
+    assert sender.close(5)
+    session = listener.accept(timeout=5)
+    assert session.recv(timeout=5) == b'other session'
+    assert listener.is_alive()
+    listener.close()
+    sender.join()
+
+
+def test_listener_session_window():
+    limit = 4 * gbn.MSS
+    listener = gbn.GBNListener(('127.0.0.1', 0), 4, link=Link(), queue_bytes=limit)
+    listener.start()
+    sender = gbn.GBNsend(('127.0.0.1', listener.sock.getsockname()[1]), 4, sid=1,
+                         link=Link(), linger=0.1)
+    sender.start()
+    data = os.urandom(100000)
+    sending = threading.Thread(target=sender.sendall, args=(data,))
+    sending.start()
+    session = listener.accept(timeout=5)
+    for _ in range(5):     # the reader stalled
+        time.sleep(0.2)
+        assert len(session.stream) <= limit
+    received = b''
+    while len(received) < len(data):
+        chunk = session.recv(4096, timeout=5)
+        assert 0 < len(chunk) <= 4096
+        received += chunk
+    assert received == data
+    sending.join()
+    assert sender.close(5)
+    assert session.recv(timeout=5) == b''
+    listener.close()
+    sender.join()
+
+
+def test_checksum_matches_byte_pair_loop():
+    rng = random.Random(4)
+    for n in list(range(8)) + [rng.randrange(8, 2000) for _ in range(200)]:     # odd and even
+        pdu = rng.randbytes(n)
+        assert ichecksum(pdu) == ichecksum_loop(pdu)
+        packet = Packet(pdu)
+        assert packet.ichecksum() == ichecksum_loop(pdu)
+    for n in range(8):  # all ones, summing to multiples of 0xFFFF
+        assert ichecksum(b'\xff' * n) == ichecksum_loop(b'\xff' * n)
+
+
+def test_header_length_even():
+    for bits in (8, 16, 32):
+        seq = seqclass(bits)(5)
+        for n in range(8):
+            for options in ({}, {Opt.WND: bytes(n)}, {Opt.SACK: bytes(n), Opt.WND: bytes(4)}):
+                packet = Packet(Type.ACK, seq, options=options)
+                assert len(packet.hdr) % 2 == 0
+                decoded = Packet(bytes(packet.pdu)).options
+                assert all(decoded[kind] == value for kind, value in options.items())
+                assert not packet.corrupt()
+
+
+def test_duplicate_ACK_updates_window():
+    sender = NullSend(8, gbn.Timer(), link=Link(), compress=6)
+    sender.send_packet(Type.DATA, bytes(100))
+    for wnd in (1400, 2000):    # the same window edge in segments, a new one in bytes
+        ack = Packet(Type.ACK, sender.base, options={Opt.WND: wnd.to_bytes(4, 'big')})
+        for pdu in sender.coalesce_ACKs([memoryview(ack.pdu)]):
+            sender.transition(gbn.Ev.Packet_Arrival, sender.received(Packet(pdu)))
+        assert sender.wnd_edge == sender.base + 1
+        assert sender.app_edge == wnd
+    assert not sender.coalesce_ACKs([memoryview(ack.pdu)])  # the same window: dropped
+
+
+def test_seq_wraparound():
+    rng = random.Random(6)
+    for bits in (8, 16, 32):
+        cls, mod = seqclass(bits), 1 << bits
+        for _ in range(1000):
+            a, b, n = rng.randrange(mod), rng.randrange(mod), rng.randrange(mod)
+            s = cls(a)
+            assert s + n == (a + n) % mod and type(s + n) is cls
+            assert s - n == (a - n) % mod and type(s - n) is cls
+            assert int(cls(b) - s) == (b - a) % mod
+            d = (b - a) % mod     # b is ahead of a if 0 < d < HALF
+            assert (s < cls(b)) == (0 < d < cls.HALF)
+            assert (s <= cls(b)) == (d < cls.HALF)
+            assert (s > cls(b)) == (not d < cls.HALF)
+            assert (s >= cls(b)) == (not 0 < d < cls.HALF)
+        last = cls(mod - 2)
+        assert list(gbn.srange(last, last + 4)) == [mod - 2, mod - 1, 0, 1]
+        assert Packet(bytes(Packet(Type.DATA, last + 3, b'x').pdu)).seq == 1
+    data = os.urandom(1000 * gbn.MSS)
+    s = sim.Simulator(1024, seqbits=16)     # a window beyond the 8-bit seq space
+    assert s.run(data) == data
+    assert s.sender.stats.window.max > Seq.HALF
+
+
+def test_timer_order_restart_and_stop():
+    now = [0.]
+    Ev = gbn.Ev
+    timer = gbn.Timer({Ev.TO_Retransmit: 1., Ev.TO_DelayedACK: 2., Ev.TO_Persist: 3.},
+                      clock=lambda: now[0])
+    assert timer.next_deadline() is None and timer.check_timeout() is None
+    for key in (Ev.TO_Persist, Ev.TO_DelayedACK, Ev.TO_Retransmit):
+        timer.start_timer(key)
+    for _ in range(1024):   # restarted on every packet: the stale entries stay bounded
+        now[0] += 1 / 1024
+        timer.start_timer(Ev.TO_Retransmit)
+    assert len(timer.heap) <= 4 * len(timer.times) + 16
+    timer.stop_timer(Ev.TO_DelayedACK)
+    assert not timer.running(Ev.TO_DelayedACK)
+    assert timer.next_deadline() == 2.     # the restarted one, not its stale entries
+    assert timer.check_timeout() is None
+    now[0] = 2.
+    assert timer.check_timeout() == Ev.TO_Retransmit
+    assert timer.check_timeout() is None
+    assert timer.next_deadline() == 3.
+    now[0] = 5.
+    assert timer.check_timeout() == Ev.TO_Persist
+    assert timer.check_timeout() is None and timer.next_deadline() is None
+
+
+def test_rto_from_rtt_samples():
+    now = [0.]
+    sender = NullSend(8, gbn.Timer(clock=lambda: now[0]), link=Link())
+
+    def round_trip(rtt, timeout=False):
+        sender.send_packet(Type.DATA, bytes(100))
+        if timeout:
+            now[0] += sender.rto
+            sender.transition(gbn.Ev.TO_Retransmit)
+        now[0] += rtt
+        ack = Packet(Type.ACK, sender.next_seq)
+        sender.transition(gbn.Ev.Packet_Arrival, sender.received(ack))
+
+    round_trip(0.1)     # the first sample: SRTT = R, RTTVAR = R/2
+    assert sender.rto == pytest.approx(0.1 + 4 * 0.05)
+    round_trip(0.2)
+    srtt, rttvar = 0.875 * 0.1 + 0.125 * 0.2, 0.75 * 0.05 + 0.25 * 0.1
+    assert sender.rto == pytest.approx(srtt + 4 * rttvar)
+    assert sender.timer.get_intv(gbn.Ev.TO_Retransmit) == sender.rto
+    rto = sender.rto
+    round_trip(0.3, timeout=True)   # backed off, and no sample from the retransmission
+    assert sender.rto == pytest.approx(2 * rto)
+    assert sender.stats.rtt.count == 2 and sender.stats.spurious == 0
+    round_trip(0.01, timeout=True)  # ACKnowledged too soon: the original was not lost
+    assert sender.stats.timeouts == 2 and sender.stats.spurious == 1
+    assert sender.rto == pytest.approx(rto)     # the backoff undone
+
+
+def test_fec_rebuilds_lost_packet():
+    rng = random.Random(23)
+    block = [Packet(Type.DATA | (Type.PSH if i == 2 else 0), Seq(250 + i), rng.randbytes(n))
+             for i, n in enumerate((1400, 7, 0, 1399))]    # across the seq wrap
+    parity = Parity(block[0].seq)
+    for packet in block:
+        parity.add(packet)
+        parity.count += 1
+    for lost in range(len(block)):
+        received = Parity(block[0].seq, parity.payload())
+        for i, packet in enumerate(block):
+            if i != lost:
+                received.add(packet)
+        rebuilt = received.rebuild(block[lost].seq)
+        assert rebuilt.pdu == block[lost].pdu
+    data = bytes(range(256)) * 1000
+    runs = {}
+    for fec in (0, 4):
+        s = sim.Simulator(16, forward=Link(loss=0.05, delay=0.01, seed=23),
+                          reverse=Link(delay=0.01), fec=fec)
+        assert s.run(data) == data
+        runs[fec] = s
+    assert runs[4].sender.stats.parity_sent and runs[4].receiver.stats.fec_recovered
+    assert runs[4].sender.stats.timeouts < runs[0].sender.stats.timeouts
+
+
+def test_transfers_reuse_entities():
+    sender, receiver = open_pair(linger=1)
+    sock = sender.sock
+    for i in range(5):
+        sender.send_message(b'message %d' % i)
+        sender.send(b'rest')
+        start = time.monotonic()
+        assert sender.close(5)
+        assert time.monotonic() - start < 1     # not waiting out the linger
+        assert receiver.recv_message(timeout=5) == b'message %d' % i
+        assert receiver.recv_message(timeout=5) == b'rest'
+        assert receiver.recv_message(timeout=5) == b''
+    assert sender.is_alive() and receiver.is_alive() and sender.sock is sock
+    sender.join()
+    receiver.join()
+    assert receiver.recv(timeout=0) == b''  # ended after lingering